@@ -3,14 +3,30 @@
 
 # Example client, sqlite storage, and webhook handler implementations
 
+import asyncio  # async variants of the API calls
 import base64  # parsing requests
+import collections  # for our LRU caches
+import concurrent.futures  # shared results for coalesced calls
+import contextlib  # timing phases for --profile
+import contextvars  # --profile items in worker threads
 import datetime  # sometimes we need to know what time it is
+import glob  # finding packed store segments
+import heapq  # merging sorted results from shards
+import http.client  # API connections with separate read timeouts
 import json  # for decoding some API reponses
 import os  # to delete temporary files
 import sqlite3  # replace with your database access method
+import sys  # interning repeated status strings
+import tarfile  # bulk exports
+import tempfile  # staging exported shipments for tar files
+import threading  # coalescing concurrent calls
+import time  # timing phases for --profile
+import tracemalloc  # memory benchmark for status records
 import urllib.parse  # parsing requests
 import urllib.request  # can also use another 3rd party library
 import urllib.error  # for images being done
+import weakref  # per-connection caches
+import zlib  # stable hashing for shards
 from typing import Union  # for mypy complaints
 
 
@@ -33,6 +49,20 @@ class settings:
         "": "LIMINAL_NETWORK_API_KEY",
     }
 
+    # how many refs per database handle_start() remembers as already in
+    # known_shipments, to skip the existence query
+    KNOWN_REFS_CACHE_SIZE = 100000
+    # how many pros per database list_images() remembers image metadata for
+    IMAGE_METADATA_CACHE_SIZE = 1000
+    # statuses that prune_images() treats as delivered; match your carriers
+    DELIVERED_STATUSES = ("DELIVERED",)
+
+    # seconds to wait for each API connection and its response headers, and
+    # then for each read of the response body; a Deadline with less time
+    # remaining lowers both
+    CONNECT_TIMEOUT = 10.0
+    READ_TIMEOUT = 60.0
+
 
 url = "https://api.liminalnetwork.com/{scac}/{method}?auth={api_key}&pro={pro}"
 
@@ -46,13 +76,380 @@ def get_api_key(scac_or_carrier_id):
     return getattr(settings, settings.CARRIER_TO_CONFIG[""])
 
 
-def get_status(pro: str, scac_or_carrier_id: Union[str, int] = "LN") -> dict:
+# --- optional timing of network, decode, database, and file phases
+
+
+class Profile:
+    """
+    Accumulates wall time per phase ("network", "decode", "db", "file") for
+    each item (a pro or request) while profiling is started with
+    start_profiling(). Time in an item outside of those phases is counted
+    as "other".
+
+    The current item is a context variable, so it carries over into threads
+    that run work with contextvars.copy_context().run(), as
+    refresh_shipment() does. Their phases can overlap, and add up to more
+    than the item's total. Phases outside any item go under "(no item)".
+    """
+
+    PHASES = ("network", "decode", "db", "file", "other")
+
+    def __init__(self):
+        self.times = collections.defaultdict(
+            lambda: collections.defaultdict(float)
+        )
+        self._item = contextvars.ContextVar("profile_item", default=None)
+
+    @contextlib.contextmanager
+    def item(self, name: str):
+        token = self._item.set(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name]["total"] += time.perf_counter() - start
+            self._item.reset(token)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            item = self._item.get() or "(no item)"
+            self.times[item][name] += time.perf_counter() - start
+
+    def summary(self, top: int = 10) -> str:
+        """
+        Returns the total time per phase over all items, followed by the
+        top slowest items with their time per phase.
+        """
+        totals = collections.defaultdict(float)
+        for phases in self.times.values():
+            other = phases["total"] - sum(
+                phases[p] for p in self.PHASES if p != "other"
+            )
+            phases["other"] = max(other, 0.0)
+            for p in self.PHASES + ("total",):
+                totals[p] += phases[p]
+
+        lines = ["time per phase:"]
+        for p in self.PHASES:
+            share = 100 * totals[p] / totals["total"] if totals["total"] else 0
+            lines.append(f"  {p:<8} {totals[p]:10.3f}s {share:5.1f}%")
+        lines.append(
+            f"slowest {min(top, len(self.times))} of {len(self.times)}:"
+        )
+        slowest = sorted(self.times.items(), key=lambda it: -it[1]["total"])
+        for name, phases in slowest[:top]:
+            detail = " ".join(
+                f"{p}={phases[p]:.3f}s" for p in self.PHASES if phases[p]
+            )
+            lines.append(f"  {name} {phases['total']:.3f}s {detail}")
+        return "\n".join(lines)
+
+
+_profile = None
+
+
+def start_profiling() -> Profile:
+    """
+    Starts timing phases of the API, database, and webhook functions in
+    this module, returning the Profile that collects them.
+    """
+    global _profile
+    _profile = Profile()
+    return _profile
+
+
+def stop_profiling():
+    global _profile
+    _profile = None
+
+
+def _phase(name: str):
+    if _profile is None:
+        return contextlib.nullcontext()
+    return _profile.phase(name)
+
+
+def _profile_item(name: str):
+    if _profile is None:
+        return contextlib.nullcontext()
+    return _profile.item(name)
+
+
+# --- timeouts and deadlines for API calls
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised when a Deadline runs out or is cancelled before an operation is
+    done. The partial attribute holds whatever the operation completed,
+    described by the function raising it.
+    """
+
+    def __init__(self, message: str = "deadline exceeded", partial=None):
+        super().__init__(message)
+        self.partial = partial
+
+
+class Deadline:
+    """
+    Time budget shared by all of the API requests of one operation, like
+    get_all_to_db() or a batch of them. Each request's timeouts are limited
+    to the time remaining, and no new request is started once it runs out
+    or after cancel() is called.
+    """
+
+    def __init__(self, seconds: float = None):
+        self.expires_at = (
+            None if seconds is None else time.monotonic() + seconds
+        )
+        self.cancelled = False
+        self._parent = None
+
+    def remaining(self) -> Union[float, None]:
+        """
+        Returns seconds remaining, 0 if expired or cancelled, or None if
+        there is no time limit.
+        """
+        if self.cancelled or (self._parent and self._parent.expired()):
+            return 0.0
+        if self.expires_at is None:
+            return None
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        return self.remaining() == 0.0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def child(self):
+        """
+        Returns a Deadline with the same expiry, which is also cancelled by
+        cancelling this one, but can be cancelled on its own.
+        """
+        child = Deadline()
+        child.expires_at = self.expires_at
+        child._parent = self
+        return child
+
+    def check(self, partial=None):
+        """
+        Raises DeadlineExceeded with the given partial results if expired
+        or cancelled.
+        """
+        if self.expired():
+            message = "cancelled" if self.cancelled else "deadline exceeded"
+            raise DeadlineExceeded(message, partial)
+
+
+class _TimeoutConnectionMixin:
+    # keeps the socket on the response, so _urlopen() can switch its timeout
+    # from connecting to reading once the headers are in
+    def getresponse(self):
+        sock = self.sock
+        response = super().getresponse()
+        response.read_sock = sock
+        return response
+
+
+class _HTTPConnection(_TimeoutConnectionMixin, http.client.HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_TimeoutConnectionMixin, http.client.HTTPSConnection):
+    pass
+
+
+class _TimeoutHandlerMixin:
+    def do_open(self, http_class, req, **http_conn_args):
+        http_class = {
+            http.client.HTTPConnection: _HTTPConnection,
+            http.client.HTTPSConnection: _HTTPSConnection,
+        }.get(http_class, http_class)
+        return super().do_open(http_class, req, **http_conn_args)
+
+
+class _HTTPHandler(_TimeoutHandlerMixin, urllib.request.HTTPHandler):
+    pass
+
+
+class _HTTPSHandler(_TimeoutHandlerMixin, urllib.request.HTTPSHandler):
+    pass
+
+
+_opener = urllib.request.build_opener(_HTTPHandler, _HTTPSHandler)
+
+
+@contextlib.contextmanager
+def _urlopen(full_url: str, deadline: Deadline = None):
+    # all API requests go through here, to apply our timeouts
+    connect_timeout = settings.CONNECT_TIMEOUT
+    read_timeout = settings.READ_TIMEOUT
+    if deadline is not None:
+        deadline.check()
+        remaining = deadline.remaining()
+        if remaining is not None:
+            connect_timeout = min(connect_timeout, remaining)
+            read_timeout = min(read_timeout, remaining)
+
+    try:
+        with _opener.open(full_url, timeout=connect_timeout) as resp:
+            # urllib has one timeout for the socket; switch it from connecting
+            # to reading the body
+            resp.read_sock.settimeout(read_timeout)
+            yield resp
+    except (TimeoutError, urllib.error.URLError) as err:
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceeded() from err
+        raise
+
+
+def _read_body(resp, deadline: Deadline = None) -> bytes:
+    # the socket timeout applies to each read, so a body that trickles in
+    # is checked against the deadline between chunks
+    chunks = []
+    while True:
+        if deadline is not None:
+            deadline.check()
+            remaining = deadline.remaining()
+            if remaining is not None:
+                resp.read_sock.settimeout(
+                    min(settings.READ_TIMEOUT, remaining)
+                )
+        chunk = resp.read1(65536)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def _read_json(full_url: str, deadline: Deadline = None):
+    with _phase("network"), _urlopen(full_url, deadline) as resp:
+        rr = _read_body(resp, deadline)
+    with _phase("decode"):
+        return json.loads(rr.decode())
+
+
+# --- coalesce concurrent identical API calls
+
+
+class SingleFlight:
+    """
+    Concurrent calls made with the same key share one underlying call, and
+    all callers receive its result (or its exception). Once the call is done,
+    the next call with that key will go out to the network again.
+
+    Both threads (via .call()) and asyncio tasks (via .call_async()) can wait
+    on the same in-flight call.
+
+    If kwargs include a Deadline as deadline, it is passed on to fn, and
+    also limits how long we wait on another caller's call. If another
+    caller's call runs out of its own deadline, we make the call again on
+    ours.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def _claim(self, key):
+        with self._lock:
+            fut = self._calls.get(key)
+            if fut is not None:
+                return fut, False
+            fut = self._calls[key] = concurrent.futures.Future()
+            # a running future can't be cancelled, so one cancelled waiter
+            # can't cancel the call for everyone else
+            fut.set_running_or_notify_cancel()
+            return fut, True
+
+    def _run(self, key, fut, fn, args, kwargs):
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as err:
+            with self._lock:
+                del self._calls[key]
+            fut.set_exception(err)
+        else:
+            with self._lock:
+                del self._calls[key]
+            fut.set_result(result)
+
+    def call(self, key, fn, *args, **kwargs):
+        """
+        Args:
+            key - hashable identifier for the call, like ("status", scac, pro)
+            fn - function to call if no identical call is in flight
+            args, kwargs - passed to fn
+
+        Returns the result of fn(*args, **kwargs), raising its exception.
+        """
+        deadline = kwargs.get("deadline")
+        while True:
+            fut, leader = self._claim(key)
+            if leader:
+                self._run(key, fut, fn, args, kwargs)
+            try:
+                return fut.result(deadline.remaining() if deadline else None)
+            except (concurrent.futures.TimeoutError, TimeoutError):
+                if not fut.done():
+                    raise DeadlineExceeded() from None
+                if not self._retry(fut, leader, deadline):
+                    raise
+
+    @staticmethod
+    def _retry(fut, leader: bool, deadline: Deadline) -> bool:
+        # true if fn raised DeadlineExceeded for another caller's deadline,
+        # and ours hasn't run out
+        return (
+            not leader
+            and isinstance(fut.exception(), DeadlineExceeded)
+            and not (deadline is not None and deadline.expired())
+        )
+
+    async def call_async(self, key, fn, *args, **kwargs):
+        """
+        As .call(), but fn runs in the default executor of the running loop,
+        so the event loop is not blocked while waiting on the network.
+        """
+        deadline = kwargs.get("deadline")
+        while True:
+            fut, leader = self._claim(key)
+            if leader:
+                asyncio.get_running_loop().run_in_executor(
+                    None, self._run, key, fut, fn, args, kwargs
+                )
+            try:
+                return await asyncio.wait_for(
+                    asyncio.shield(asyncio.wrap_future(fut)),
+                    deadline.remaining() if deadline else None,
+                )
+            except (asyncio.TimeoutError, TimeoutError):
+                if not fut.done():
+                    raise DeadlineExceeded() from None
+                if not self._retry(fut, leader, deadline):
+                    raise
+
+
+# shared by get_status(), get_individual_images(), and get_images_to_db()
+single_flight = SingleFlight()
+
+
+def get_status(
+    pro: str,
+    scac_or_carrier_id: Union[str, int] = "LN",
+    deadline: Deadline = None,
+) -> dict:
     """
     Args:
         pro - the tracking number or pro of the shipment you would like information about
         scac_or_carrier_id - which carrier to use, either a 4-letter SCAC,
             the string "LN", or the carrier_id shown on the Carrier Credentials page;
             defaults to "LN" for Liminal Network Final Mile Photos service
+        deadline - optional Deadline limiting the time for the request(s)
 
     Returns one of:
             {
@@ -67,14 +464,40 @@ def get_status(pro: str, scac_or_carrier_id: Union[str, int] = "LN") -> dict:
                 'scac': '...',
                 'pro': '...'
             }
+
+    Concurrent calls for the same pro and carrier share one API request.
+    """
+    key = ("status", str(scac_or_carrier_id), pro)
+    return single_flight.call(
+        key, _get_status, pro, scac_or_carrier_id, deadline=deadline
+    )
+
+
+async def get_status_async(
+    pro: str,
+    scac_or_carrier_id: Union[str, int] = "LN",
+    deadline: Deadline = None,
+) -> dict:
     """
+    As get_status(), for use from asyncio code. Shares in-flight requests with
+    get_status() calls made from other threads.
+    """
+    key = ("status", str(scac_or_carrier_id), pro)
+    return await single_flight.call_async(
+        key, _get_status, pro, scac_or_carrier_id, deadline=deadline
+    )
+
+
+def _get_status(
+    pro: str, scac_or_carrier_id: Union[str, int], deadline: Deadline = None
+) -> dict:
     full_url = url.format(
         method="status",
         api_key=get_api_key(scac_or_carrier_id),
         pro=pro,
         scac=scac_or_carrier_id,
     )
-    return json.loads(urllib.request.urlopen(full_url).read().decode())
+    return _read_json(full_url, deadline)
 
 
 def get_pdf_images(
@@ -82,6 +505,7 @@ def get_pdf_images(
     which: str,
     scac_or_carrier_id: Union[str, int] = "LN",
     test_output: bool = False,
+    deadline: Deadline = None,
 ):
     """
     Args:
@@ -92,6 +516,7 @@ def get_pdf_images(
             defaults to "LN" for Liminal Network Final Mile Photos service
         test_output - if true, check the content of the output to verify that
             it is probably a PDF
+        deadline - optional Deadline limiting the time for the request(s)
 
     Fetches the images for the given PRO from Liminal Network as a PDF,
     saving to "{pro}_{which}.pdf" on the local filesystem.
@@ -100,6 +525,28 @@ def get_pdf_images(
         Error message returned by server on non-2xx response as dictionary
         Filename of pdf stored for 2xx responses as string
     """
+    downloaded = _download_pdf(
+        pro, which, scac_or_carrier_id, test_output, deadline
+    )
+    if isinstance(downloaded, dict):
+        return downloaded
+    filename, rr = downloaded
+
+    # should be <pro>.pdf
+    with _phase("file"), open(filename, "wb") as out:
+        out.write(rr)
+
+    return filename
+
+
+def _download_pdf(
+    pro: str,
+    which: str,
+    scac_or_carrier_id: Union[str, int],
+    test_output: bool,
+    deadline: Deadline = None,
+) -> Union[tuple, dict]:
+    # (filename, data), or the error dict; nothing is written to disk
     full_url = (
         url.format(
             method=which,
@@ -110,12 +557,13 @@ def get_pdf_images(
         + "&dl=1"
     )
 
-    with urllib.request.urlopen(full_url) as resp:
-        rr = resp.read()
+    with _phase("network"), _urlopen(full_url, deadline) as resp:
+        rr = _read_body(resp, deadline)
         filename_header = resp.headers["content-disposition"]
 
     if not filename_header:
-        return json.loads(rr.decode())
+        with _phase("decode"):
+            return json.loads(rr.decode())
 
     filename = filename_header.partition("=")[-1].strip('"')
     if test_output:
@@ -123,12 +571,7 @@ def get_pdf_images(
             "File should be a pdf, not a: " + filename.rpartition(".")[-1]
         )
         assert b"PDF" in rr[:4], "File does not seem to be a pdf"
-
-    # should be <pro>.pdf
-    with open(filename, "wb") as out:
-        out.write(rr)
-
-    return filename
+    return filename, rr
 
 
 def get_individual_images(
@@ -137,6 +580,7 @@ def get_individual_images(
     indexes: tuple = (),
     scac_or_carrier_id: Union[str, int] = "LN",
     test_output: bool = False,
+    deadline: Deadline = None,
 ):
     """
     Args:
@@ -152,6 +596,7 @@ def get_individual_images(
             defaults to "LN" for Liminal Network Final Mile Photos service
         test_output - if true, check the content of the each output file to
             verify that it is probably a jpeg image
+        deadline - optional Deadline limiting the time for the request(s)
 
     Fetches the images for the given PRO from Liminal Network as jpegs,
     saving to "<pro>_<which>_<number>.jpg" on the local filesystem for any
@@ -159,11 +604,88 @@ def get_individual_images(
 
     Returns:
         List of image filenames stored on the local disk.
+
+    If the deadline runs out, raises DeadlineExceeded with the list of
+    image filenames stored so far as its partial results.
+
+    Concurrent calls with the same arguments share one set of API requests.
     """
     if not indexes:
         # up to 5 normal images, 5 issue images
         indexes = tuple(range(1, 11))
+    indexes = tuple(indexes)
+
+    key = ("images", str(scac_or_carrier_id), pro, which, indexes, test_output)
+    return single_flight.call(
+        key,
+        _get_individual_images,
+        pro,
+        which,
+        indexes,
+        scac_or_carrier_id,
+        test_output,
+        deadline=deadline,
+    )
+
+
+async def get_individual_images_async(
+    pro: str,
+    which: str,
+    indexes: tuple = (),
+    scac_or_carrier_id: Union[str, int] = "LN",
+    test_output: bool = False,
+    deadline: Deadline = None,
+):
+    """
+    As get_individual_images(), for use from asyncio code. Shares in-flight
+    requests with get_individual_images() calls made from other threads.
+    """
+    indexes = tuple(indexes) or tuple(range(1, 11))
+    key = ("images", str(scac_or_carrier_id), pro, which, indexes, test_output)
+    return await single_flight.call_async(
+        key,
+        _get_individual_images,
+        pro,
+        which,
+        indexes,
+        scac_or_carrier_id,
+        test_output,
+        deadline=deadline,
+    )
+
+
+def _get_individual_images(
+    pro: str,
+    which: str,
+    indexes: tuple,
+    scac_or_carrier_id: Union[str, int],
+    test_output: bool,
+    deadline: Deadline = None,
+):
+    written = []
+    try:
+        for filename, rr in _download_images(
+            pro, which, indexes, scac_or_carrier_id, test_output, deadline
+        ):
+            # image=0 will be <pro>.png
+            # image=1+ will be <pro>_<image_type>.jpg
+            with _phase("file"), open(filename, "wb") as out:
+                out.write(rr)
+            written.append(filename)
+    except DeadlineExceeded as err:
+        raise DeadlineExceeded(str(err), written) from err
+    return written
 
+
+def _download_images(
+    pro: str,
+    which: str,
+    indexes: tuple,
+    scac_or_carrier_id: Union[str, int],
+    test_output: bool,
+    deadline: Deadline = None,
+):
+    # yields (filename, data) for each image; nothing is written to disk
     partial_url = (
         url.format(
             method=which,
@@ -173,10 +695,11 @@ def get_individual_images(
         )  # providing dl=1 flag ensures we get content-disposition response header
         + "&dl=1"
     )
-    written = []
     for i in indexes:
-        with urllib.request.urlopen(partial_url + f"&image={i}") as resp:
-            rr = resp.read()
+        with _phase("network"), _urlopen(
+            partial_url + f"&image={i}", deadline
+        ) as resp:
+            rr = _read_body(resp, deadline)
             filename_header = resp.headers["content-disposition"]
 
         if not filename_header:
@@ -193,15 +716,7 @@ def get_individual_images(
             ), f"{filename} does not have expected {typ} content"
 
         print("got a file from the api", filename, i)
-
-        # image=0 will be <pro>.png
-        # image=1+ will be <pro>_<image_type>.jpg
-        with open(filename, "wb") as out:
-            out.write(rr)
-
-        written.append(filename)
-
-    return written
+        yield filename, rr
 
 
 def register_hook(
@@ -211,6 +726,7 @@ def register_hook(
     pro: str = "",
     bol: str = "",
     tracking: str = "",
+    deadline: Deadline = None,
 ) -> Union[str, dict]:
     """
     Args:
@@ -221,6 +737,7 @@ def register_hook(
         pro - use one of pro, bol, or tracking
         bol - use one of pro, bol, or tracking
         tracking - use one of pro, bol, or tracking
+        deadline - optional Deadline limiting the time for the request(s)
 
     Will call Liminal Network's webhook registry API for the scac/shipment pair provided provided.
 
@@ -254,43 +771,37 @@ def register_hook(
         rep = ("bol=" + bol) if bol else ("tracking=" + tracking)
         base = base.replace("pro=", rep, 1)
 
-    ret = json.loads(urllib.request.urlopen(base).read().decode())
+    ret = _read_json(base, deadline)
     if "webhook_id" in ret:
         return ret["webhook_id"]
 
     return ret
 
 
-def get_hook_status(webhook_id: str) -> dict:
+def get_hook_status(webhook_id: str, deadline: Deadline = None) -> dict:
     """
     Args:
         webhook_id - a webhook_id returned by register_hook() that is still valid
+        deadline - optional Deadline limiting the time for the request(s)
 
     Returns:
         dictionary containing your status, or an error indicating that the webhook is invalid
     """
-    return json.loads(
-        urllib.request.urlopen(f"https://api.liminalnetwork.com/{webhook_id}")
-        .read()
-        .decode()
-    )
+    return _read_json(f"https://api.liminalnetwork.com/{webhook_id}", deadline)
 
 
-def cancel_hook(webhook_id: str) -> dict:
+def cancel_hook(webhook_id: str, deadline: Deadline = None) -> dict:
     """
     Args:
         webhook_id - a webhook_id returned by register_hook() that is still valid
+        deadline - optional Deadline limiting the time for the request(s)
 
     Returns:
         confirmation that your webhook was deleted, or an error indicating that the
         webhook is invalid (was already deleted, or it never existed)
     """
-    return json.loads(
-        urllib.request.urlopen(
-            f"https://api.liminalnetwork.com/{webhook_id}/cancel"
-        )
-        .read()
-        .decode()
+    return _read_json(
+        f"https://api.liminalnetwork.com/{webhook_id}/cancel", deadline
     )
 
 
@@ -302,6 +813,7 @@ def limited_use_key(
     pro: str = None,
     bol: str = None,
     tracking: str = None,
+    deadline: Deadline = None,
 ) -> Union[str, dict]:
     """
     Args:
@@ -315,6 +827,7 @@ def limited_use_key(
         pro - pick one of pro, bol, or tracking, and provide your number
         bol - pick one of pro, bol, or tracking, and provide your number
         tracking - pick one of pro, bol, or tracking, and provide your number
+        deadline - optional Deadline limiting the time for the request(s)
 
     On success, returns:
 
@@ -341,7 +854,7 @@ def limited_use_key(
         rep = ("bol=" + bol) if bol else ("tracking=" + tracking)
         base = base.replace("pro=", rep, 1)
 
-    ret = json.loads(urllib.request.urlopen(base).read().decode())
+    ret = _read_json(base, deadline)
     if "auth" in ret:
         return ret["auth"]
 
@@ -349,9 +862,306 @@ def limited_use_key(
     return ret
 
 
+# --- pack statuses and images into a few large files
+
+
+class PackedStore:
+    """
+    Alternative to one file per status and image for --files mode. Statuses
+    are appended to "statuses-NNNNN.jsonl" segments and images to
+    "images-NNNNN.pack" segments, with a new segment started once the
+    current one reaches segment_size bytes; opening the store again carries
+    on with the latest segments that aren't full. Every record is also
+    appended to "index.jsonl", which is read on open to find the latest
+    status and images for each pro without scanning the segments.
+
+    Records are never rewritten in place; compact() copies only the latest
+    records into new segments and removes the old ones.
+    """
+
+    def __init__(self, dirname: str, segment_size: int = 256 * 1024 * 1024):
+        self.dirname = dirname
+        self.segment_size = segment_size
+        self._lock = threading.RLock()
+        self._statuses = {}  # pro -> (segment, offset, length)
+        self._images = {}  # pro -> {name: (segment, offset, length)}
+        self._live = 0  # bytes in the latest records
+        self._total = 0  # bytes in all records
+        self._writers = {}  # kind -> (segment, open file)
+        os.makedirs(dirname, exist_ok=True)
+
+        latest = {}  # kind -> highest segment number
+        for path in self._segments():
+            kind, _, rest = os.path.basename(path).partition("-")
+            segment = int(rest.partition(".")[0])
+            latest[kind] = max(latest.get(kind, 0), segment)
+        # segment numbers are shared by both kinds, and only ever increase
+        self._segment = max(latest.values(), default=0)
+        index_path = os.path.join(dirname, "index.jsonl")
+        good = 0  # end of the last complete index line
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as inp:
+                for line in inp:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        self._track(*json.loads(line))
+                    except ValueError:
+                        break
+                    good += len(line)
+        self._index = open(index_path, "ab")
+        if self._index.tell() > good:
+            # partial last line from a crash; its data is lost, and new
+            # entries must start on a line of their own
+            self._index.truncate(good)
+
+        # carry on appending to the latest segments, rather than starting
+        # new ones each time the store is opened
+        for kind, segment in latest.items():
+            path = self._path(kind, segment)
+            if os.path.getsize(path) < segment_size:
+                self._writers[kind] = (segment, open(path, "ab"))
+
+    def _segments(self) -> list:
+        return glob.glob(
+            os.path.join(self.dirname, "statuses-*.jsonl")
+        ) + glob.glob(os.path.join(self.dirname, "images-*.pack"))
+
+    def _path(self, kind: str, segment: int) -> str:
+        ext = "jsonl" if kind == "statuses" else "pack"
+        return os.path.join(self.dirname, f"{kind}-{segment:05d}.{ext}")
+
+    def _track(self, kind, pro, name, segment, offset, length):
+        if kind == "statuses":
+            old = self._statuses.get(pro)
+            self._statuses[pro] = (segment, offset, length)
+        else:
+            images = self._images.setdefault(pro, {})
+            old = images.get(name)
+            images[name] = (segment, offset, length)
+        self._total += length
+        self._live += length - (old[2] if old else 0)
+
+    def _append(self, kind: str, pro: str, name: str, data: bytes):
+        with self._lock, _phase("file"):
+            segment, out = self._writers.get(kind, (None, None))
+            if out is None or out.tell() >= self.segment_size:
+                if out is not None:
+                    out.close()
+                self._segment = segment = self._segment + 1
+                out = open(self._path(kind, segment), "ab")
+                self._writers[kind] = (segment, out)
+            entry = [kind, pro, name, segment, out.tell(), len(data)]
+            out.write(data)
+            out.flush()
+            # written after the data, so the index never points past it
+            self._index.write(json.dumps(entry).encode() + b"\n")
+            self._index.flush()
+            self._track(*entry)
+
+    def _read(self, kind: str, location: tuple) -> bytes:
+        segment, offset, length = location
+        with _phase("file"), open(self._path(kind, segment), "rb") as inp:
+            inp.seek(offset)
+            return inp.read(length)
+
+    def _close_files(self):
+        for _, out in self._writers.values():
+            out.close()
+        self._writers.clear()
+        self._index.close()
+
+    def put_status(self, pro: str, status: dict):
+        self._append("statuses", pro, "", json.dumps(status).encode() + b"\n")
+
+    def put_image(self, pro: str, name: str, data: bytes):
+        self._append("images", pro, name, data)
+
+    def get_status(self, pro: str) -> Union[dict, None]:
+        with self._lock:
+            location = self._statuses.get(pro)
+            if not location:
+                return None
+            return json.loads(self._read("statuses", location))
+
+    def list_images(self, pro: str) -> list:
+        with self._lock:
+            return sorted(self._images.get(pro, ()))
+
+    def get_image(self, pro: str, name: str) -> Union[bytes, None]:
+        with self._lock:
+            location = self._images.get(pro, {}).get(name)
+            return self._read("images", location) if location else None
+
+    def pros(self) -> list:
+        with self._lock:
+            return sorted(set(self._statuses) | set(self._images))
+
+    def close(self):
+        with self._lock:
+            self._close_files()
+
+    def compact(self):
+        """
+        Copies the latest status and images for each pro into new segments,
+        then replaces the index and removes the old segments. The old index
+        stays in place until the new one is complete, so a crash during
+        compaction leaves the store as it was. Writers wait until done.
+        """
+        with self._lock:
+            self._close_files()
+            old_segments = self._segments()
+            records = [
+                ("statuses", pro, "", loc)
+                for pro, loc in self._statuses.items()
+            ] + [
+                ("images", pro, name, loc)
+                for pro, images in self._images.items()
+                for name, loc in images.items()
+            ]
+            self._statuses, self._images = {}, {}
+            self._live = self._total = 0
+            index_path = os.path.join(self.dirname, "index.jsonl")
+            self._index = open(index_path + ".tmp", "wb")
+
+            for kind, pro, name, location in records:
+                self._append(kind, pro, name, self._read(kind, location))
+
+            self._close_files()
+            os.replace(index_path + ".tmp", index_path)
+            self._index = open(index_path, "ab")
+            for path in old_segments:
+                os.unlink(path)
+
+    def maybe_compact(self, min_garbage_ratio: float = 0.5) -> bool:
+        """
+        Calls compact() if at least min_garbage_ratio of the stored bytes
+        belong to records that have since been replaced.
+
+        Returns:
+            True if the store was compacted
+        """
+        with self._lock:
+            garbage = self._total - self._live
+            if not garbage or garbage < min_garbage_ratio * self._total:
+                return False
+            self.compact()
+            return True
+
+
 # --- take web -> disk output and insert into sqlite database
 
 
+class LRUCache:
+    """
+    Thread-safe mapping that holds at most maxsize items, discarding the
+    least recently used item when full.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return True
+            return False
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return self._data[key]
+            return default
+
+    def set(self, key, value=True):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class CachedConnection(sqlite3.Connection):
+    """
+    sqlite3 connection that can keep the in-memory caches used by
+    handle_start() and list_images(). Plain sqlite3.Connection objects can't
+    be weakly referenced, so those always go to the database.
+
+    Use sqlite3.connect(filename, factory=CachedConnection), or
+    CachedConnection(filename).
+    """
+
+
+# conn -> LRUCache, dropped along with the conn
+_conn_caches_lock = threading.Lock()
+_known_refs_by_conn = weakref.WeakKeyDictionary()  # refs in known_shipments
+_image_metadata_by_conn = weakref.WeakKeyDictionary()  # list_images() rows
+
+
+def _conn_cache(caches, conn, maxsize: int = None):
+    # returns None if conn can't be weakly referenced, or if there's no cache
+    # yet and maxsize isn't given to create one
+    conn = getattr(conn, "conn", conn)
+    with _conn_caches_lock:
+        try:
+            cache = caches.get(conn)
+        except TypeError:
+            return None
+        if cache is None and maxsize is not None:
+            cache = caches[conn] = LRUCache(maxsize)
+        return cache
+
+
+def _forget_conn_cache(caches, conn):
+    conn = getattr(conn, "conn", conn)
+    with _conn_caches_lock:
+        try:
+            caches.pop(conn, None)
+        except TypeError:
+            pass
+
+
+def _known_refs(conn) -> Union[LRUCache, None]:
+    # filled as handle_start() sees refs, not up front
+    return _conn_cache(
+        _known_refs_by_conn, conn, settings.KNOWN_REFS_CACHE_SIZE
+    )
+
+
+def _remember_known_ref(conn, pro: str):
+    # only updates caches that handle_start() has already created
+    refs = _conn_cache(_known_refs_by_conn, conn)
+    if refs is not None:
+        refs.set(pro)
+
+
+def _forget_known_ref(conn, pro: str):
+    refs = _conn_cache(_known_refs_by_conn, conn)
+    if refs is not None:
+        refs.pop(pro)
+
+
+def _forget_image_metadata(conn, known_pro: str):
+    metadata = _conn_cache(_image_metadata_by_conn, conn)
+    if metadata is not None:
+        metadata.pop(known_pro)
+
+
 def setup_schema(conn):
     """
     Args:
@@ -360,17 +1170,72 @@ def setup_schema(conn):
     Applies embedded ddl to the given conn.
 
     Note: syntax is valid SQLite3, unknown compatibility with other databases.
+
+    New databases are created with auto_vacuum=INCREMENTAL, so space freed
+    by prune_images() can be returned with incremental_vacuum(). See
+    enable_incremental_vacuum() for existing databases.
+
+    Triggers keep known_shipments.change_seq and updated_at current for
+    every write, for changes_since(), numbering changes from the one-row
+    change_counter table. Databases created before change_seq existed get
+    the column added, numbering existing rows in insert order.
+    Databases created before delivery_date existed get the column added,
+    empty for existing rows.
     """
-    ddl = [
+    # only has an effect before the first table is created
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute(
         """
         CREATE TABLE IF NOT EXISTS known_shipments(
             pro TEXT UNIQUE ON CONFLICT REPLACE,
             status TEXT,
             longstatus TEXT,
             delivery_time TEXT,
-            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            change_seq INTEGER,
+            delivery_date TEXT
         );
-        """,
+        """
+    )
+    columns = [
+        row[1] for row in conn.execute("PRAGMA table_info(known_shipments)")
+    ]
+    if "change_seq" not in columns:
+        conn.execute(
+            "ALTER TABLE known_shipments ADD COLUMN change_seq INTEGER"
+        )
+        conn.execute("UPDATE known_shipments SET change_seq = rowid")
+    if "delivery_date" not in columns:
+        conn.execute(
+            "ALTER TABLE known_shipments ADD COLUMN delivery_date TEXT"
+        )
+    conn.commit()
+
+    # change_seq numbers come from a counter that only goes up; the
+    # max(change_seq) + 1 used before could hand a replaced row its own
+    # number back
+    counter = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+        ["change_counter"],
+    ).fetchone()
+    if not counter:
+        for trigger in (
+            "known_shipments_insert_change",
+            "known_shipments_update_change",
+            "shipment_images_insert_change",
+        ):
+            conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        conn.execute("CREATE TABLE change_counter(seq INTEGER NOT NULL)")
+        conn.execute(
+            """
+            INSERT INTO change_counter(seq)
+            SELECT coalesce(max(change_seq), 0) FROM known_shipments
+        """
+        )
+        conn.commit()
+    bump_seq = "UPDATE change_counter SET seq = seq + 1;"
+    next_seq = "(SELECT seq FROM change_counter)"
+    ddl = [
         """
         CREATE TABLE IF NOT EXISTS shipment_images(
             known_pro TEXT REFERENCES known_shipments(pro) ON DELETE CASCADE,
@@ -381,6 +1246,58 @@ def setup_schema(conn):
                 ON CONFLICT REPLACE
         );
         """,
+        # for list_shipments() keyset pagination
+        """
+        CREATE INDEX IF NOT EXISTS known_shipments_updated
+            ON known_shipments(updated_at, pro);
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS known_shipments_status_updated
+            ON known_shipments(status, updated_at, pro);
+        """,
+        # for changes_since()
+        """
+        CREATE INDEX IF NOT EXISTS known_shipments_change_seq
+            ON known_shipments(change_seq);
+        """,
+        # for prune_images(); pruned rows drop out of these
+        """
+        CREATE INDEX IF NOT EXISTS shipment_images_unpruned_updated
+            ON shipment_images(updated_at) WHERE image_data IS NOT NULL;
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS shipment_images_unpruned_pro
+            ON shipment_images(known_pro) WHERE image_data IS NOT NULL;
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS known_shipments_insert_change
+        AFTER INSERT ON known_shipments
+        BEGIN
+            {bump_seq}
+            UPDATE known_shipments SET change_seq = {next_seq}
+            WHERE rowid = NEW.rowid;
+        END;
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS known_shipments_update_change
+        AFTER UPDATE OF pro, status, longstatus, delivery_time, delivery_date
+        ON known_shipments
+        BEGIN
+            {bump_seq}
+            UPDATE known_shipments
+            SET change_seq = {next_seq}, updated_at = CURRENT_TIMESTAMP
+            WHERE rowid = NEW.rowid;
+        END;
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS shipment_images_insert_change
+        AFTER INSERT ON shipment_images
+        BEGIN
+            {bump_seq}
+            UPDATE known_shipments SET change_seq = {next_seq}
+            WHERE pro = NEW.known_pro;
+        END;
+        """,
     ]
     for d_i in ddl:
         conn.execute(d_i)
@@ -407,91 +1324,1252 @@ def insert_data(conn, table: str, data: dict):
     columns = ",".join(cols)
     vals = ",".join(len(cols) * ["?"])
     query = f"INSERT INTO {table}({columns}) VALUES ({vals});" ""
-    conn.execute(query, [data[k] for k in cols])
-    conn.commit()
+    with _phase("db"):
+        conn.execute(query, [data[k] for k in cols])
+        conn.commit()
+    if table == "known_shipments":
+        _remember_known_ref(conn, data["pro"])
+    elif table == "shipment_images":
+        _forget_image_metadata(conn, data["known_pro"])
+
+
+def get_status_to_db(
+    conn,
+    pro: str,
+    scac_or_carrier_id: Union[str, int] = "LN",
+    deadline: Deadline = None,
+) -> dict:
+    """
+    Args:
+        conn - sqlite3 connection object
+        pro - pro to get images for
+        scac_or_carrier_id - which carrier to use, either a 4-letter SCAC,
+            LN, or the carrier_id shown on the Carrier Credentials page;
+            defaults to "LN" for Liminal Network Final Mile Photos service
+        deadline - optional Deadline limiting the time for the request
+
+    Inserts the status metadata for the given pro into the database specified,
+    into the table named known_shipments. On error will not change the DB.
+
+    Returns:
+        get_status() call results for testing / verification
+    """
+    status = get_status(pro, scac_or_carrier_id, deadline)
+    if "errors" in status:
+        return status
+    to_insert = {
+        k: status[k] for k in ("pro", "status", "longstatus", "delivery_time")
+    }
+    to_insert["pro"] = str(scac_or_carrier_id) + "-" + to_insert["pro"]
+    to_insert["delivery_date"] = status.get("delivery_date")
+    insert_data(conn, "known_shipments", to_insert)
+    return status
+
+
+def get_images_to_db(
+    conn,
+    pro: str,
+    scac_or_carrier_id: Union[str, int] = "LN",
+    deadline: Deadline = None,
+):
+    """
+    Args:
+        conn - sqlite3 connection object
+        pro - pro to get images for
+        scac_or_carrier_id - which carrier to use, either a 4-letter SCAC,
+            LN, or the carrier_id shown on the Carrier Credentials page;
+            defaults to "LN" for Liminal Network Final Mile Photos service
+        deadline - optional Deadline limiting the time for the requests
+
+    Inserts all images for the given pro into the database specified,
+    into the table named shipment_images.
+
+    If the deadline runs out, the images fetched so far are inserted, then
+    DeadlineExceeded is raised with their filenames as its partial results.
+
+    Concurrent calls for the same pro and carrier share one set of API
+    requests, and each inserts the shared images into its own conn.
+    """
+    identifier = f"{scac_or_carrier_id}-{pro}"
+    key = ("image_data", str(scac_or_carrier_id), pro)
+    exceeded = None
+    try:
+        images = single_flight.call(
+            key, _fetch_image_data, pro, scac_or_carrier_id, deadline=deadline
+        )
+    except DeadlineExceeded as err:
+        images, exceeded = err.partial or [], err
+
+    for image_name, img_data in images:
+        # If you wanted to use an object store instead,
+        # change this code.
+        to_insert = {
+            "known_pro": identifier,
+            "image_identifier": image_name,
+            "image_data": img_data,
+        }
+        insert_data(conn, "shipment_images", to_insert)
+
+    if exceeded is not None:
+        inserted = [image_name for image_name, _ in images]
+        raise DeadlineExceeded(str(exceeded), inserted) from exceeded
+
+
+def _fetch_image_data(
+    pro: str, scac_or_carrier_id: Union[str, int], deadline: Deadline = None
+) -> list:
+    # keeps the images in memory, so that concurrent callers don't race to
+    # write, read, and delete the same files
+    out = []
+    try:
+        for image in _download_images(
+            pro,
+            "proof",
+            tuple(range(1, 11)),
+            scac_or_carrier_id,
+            False,
+            deadline,
+        ):
+            out.append(image)
+    except DeadlineExceeded as err:
+        raise DeadlineExceeded(str(err), out) from err
+    return out
+
+
+def get_all_to_db(
+    conn,
+    pro: str,
+    scac_or_carrier_id: Union[str, int] = "LN",
+    deadline: Deadline = None,
+) -> dict:
+    """
+    Args:
+        conn - sqlite3 connection object
+        pro - pro to get status and images for
+        scac_or_carrier_id - which carrier to use, either a 4-letter SCAC,
+            LN, or the carrier_id shown on the Carrier Credentials page;
+            defaults to "LN" for Liminal Network Final Mile Photos service
+        deadline - optional Deadline shared by the status and image requests
+
+    Will call get_status_to_db(), and if the status is one to expect images,
+    will subsequently call get_images_to_db().
+
+    If the deadline runs out, raises DeadlineExceeded with partial results
+    of {"status": get_status() results or None, "images": [filenames]}.
+
+    Returns:
+        get_status() call results for testing / verification
+    """
+    status = None
+    try:
+        status = get_status_to_db(conn, pro, scac_or_carrier_id, deadline)
+        if "errors" not in status:
+            # can try to get any uploaded images any time there isn't an error
+            get_images_to_db(conn, pro, scac_or_carrier_id, deadline)
+    except DeadlineExceeded as err:
+        images = err.partial if status is not None else None
+        partial = {"status": status, "images": images or []}
+        raise DeadlineExceeded(str(err), partial) from err
+    return status
+
+
+def get_many_to_db(
+    conn,
+    pros: list,
+    scac_or_carrier_id: Union[str, int] = "LN",
+    deadline: Deadline = None,
+) -> dict:
+    """
+    Args:
+        conn - sqlite3 connection object
+        pros - pros to get status and images for
+        scac_or_carrier_id - which carrier to use, either a 4-letter SCAC,
+            LN, or the carrier_id shown on the Carrier Credentials page;
+            defaults to "LN" for Liminal Network Final Mile Photos service
+        deadline - optional Deadline shared by every request of the batch
+
+    Calls get_all_to_db() for each pro in turn, stopping when the deadline
+    runs out.
+
+    Returns:
+        {
+            "done": [pros stored],
+            "errors": {pro: get_status() error results},
+            "unfinished": [pros not done when the deadline ran out],
+            "partial": {pro: partial results of the interrupted pro},
+        }
+    """
+    results = {"done": [], "errors": {}, "unfinished": [], "partial": {}}
+    for i, pro in enumerate(pros):
+        try:
+            with _profile_item(pro):
+                status = get_all_to_db(conn, pro, scac_or_carrier_id, deadline)
+        except DeadlineExceeded as err:
+            results["unfinished"] = list(pros[i:])
+            results["partial"][pro] = err.partial
+            break
+        if "errors" in status:
+            results["errors"][pro] = status
+        else:
+            results["done"].append(pro)
+    return results
+
+
+def refresh_shipment(
+    conn,
+    pro: str,
+    scac_or_carrier_id: Union[str, int] = "LN",
+    pdfs: tuple = ("lading",),
+    deadline: Deadline = None,
+) -> dict:
+    """
+    Args:
+        conn - sqlite3 connection object
+        pro - pro to get status, images, and documents for
+        scac_or_carrier_id - which carrier to use, either a 4-letter SCAC,
+            LN, or the carrier_id shown on the Carrier Credentials page;
+            defaults to "LN" for Liminal Network Final Mile Photos service
+        pdfs - which pdf documents to also fetch, any of "lading" and "proof"
+        deadline - optional Deadline for the whole refresh
+
+    Fetches the status, the proof images, and the requested pdfs at the same
+    time, so this takes about as long as the slowest of them, then stores
+    everything in one transaction. Pdfs are stored in shipment_images under
+    the filename returned by the API. If the status has errors, the other
+    requests are cancelled and nothing is stored.
+
+    If the deadline runs out, whatever finished is stored, then
+    DeadlineExceeded is raised with the usual return value as its partial
+    results.
+
+    Nothing is written to the local filesystem, and concurrent refreshes or
+    get_images_to_db() calls for the same pro share the image requests.
+
+    Returns:
+        {
+            "status": get_status() results,
+            "images": [image filenames stored],
+            "pdfs": {which: filename stored, or the error dictionary},
+        }
+    """
+    # cancelled on a status error without cancelling the caller's deadline
+    ours = deadline.child() if deadline is not None else Deadline()
+    pool = concurrent.futures.ThreadPoolExecutor(2 + len(pdfs))
+
+    def submit(fn, *args, **kwargs):
+        # keeps the --profile item of the caller
+        run = contextvars.copy_context().run
+        return pool.submit(run, fn, *args, **kwargs)
+
+    status_future = submit(get_status, pro, scac_or_carrier_id, ours)
+    image_future = submit(
+        single_flight.call,
+        ("image_data", str(scac_or_carrier_id), pro),
+        _fetch_image_data,
+        pro,
+        scac_or_carrier_id,
+        deadline=ours,
+    )
+    pdf_futures = {
+        which: submit(
+            _download_pdf, pro, which, scac_or_carrier_id, False, ours
+        )
+        for which in pdfs
+    }
+    # don't wait on cancelled requests; nothing they fetch touches the disk.
+    # Queued requests still run: they stop at their first deadline check
+    pool.shutdown(wait=False)
+
+    result = {"status": None, "images": [], "pdfs": {}}
+    exceeded = None
+    try:
+        result["status"] = status_future.result()
+    except DeadlineExceeded as err:
+        exceeded = err
+    except BaseException:
+        ours.cancel()
+        raise
+    if result["status"] is not None and "errors" in result["status"]:
+        ours.cancel()
+        return result
+
+    images = []
+    try:
+        images = image_future.result()
+    except DeadlineExceeded as err:
+        images, exceeded = err.partial or [], err
+    except BaseException:
+        ours.cancel()
+        raise
+
+    pdf_data = []
+    for which, future in pdf_futures.items():
+        try:
+            fetched = future.result()
+        except DeadlineExceeded as err:
+            exceeded = err
+            continue
+        except BaseException:
+            ours.cancel()
+            raise
+        if isinstance(fetched, dict):
+            result["pdfs"][which] = fetched
+        else:
+            result["pdfs"][which] = fetched[0]
+            pdf_data.append(fetched)
+
+    batch = _CommitLater(conn)
+    identifier = f"{scac_or_carrier_id}-{pro}"
+    try:
+        if result["status"] is not None:
+            to_insert = {
+                k: result["status"][k]
+                for k in ("pro", "status", "longstatus", "delivery_time")
+            }
+            to_insert["pro"] = identifier
+            to_insert["delivery_date"] = result["status"].get("delivery_date")
+            insert_data(batch, "known_shipments", to_insert)
+        for image_name, img_data in images + pdf_data:
+            to_insert = {
+                "known_pro": identifier,
+                "image_identifier": image_name,
+                "image_data": img_data,
+            }
+            insert_data(batch, "shipment_images", to_insert)
+        with _phase("db"):
+            conn.commit()
+    except BaseException:
+        conn.rollback()
+        # the pro inserted above is no longer known
+        _forget_conn_cache(_known_refs_by_conn, conn)
+        raise
+    result["images"] = [image_name for image_name, _ in images]
+
+    if exceeded is not None:
+        raise DeadlineExceeded(str(exceeded), result) from exceeded
+    return result
+
+
+# --- compact status results for bulk jobs
+
+
+_STATUS_FIELDS = (
+    "pro",
+    "scac",
+    "status",
+    "longstatus",
+    "delivery_date",
+    "delivery_time",
+)
+
+
+def _status_values(status: dict, scac_or_carrier_id) -> tuple:
+    scac = (
+        status.get("scac")
+        if scac_or_carrier_id is None
+        else scac_or_carrier_id
+    )
+    return (
+        status["pro"],
+        # status strings repeat across shipments; share one copy of each
+        sys.intern(str(scac)),
+        sys.intern(status["status"]),
+        sys.intern(status["longstatus"]),
+        status.get("delivery_date"),
+        status.get("delivery_time"),
+    )
+
+
+class StatusRecord:
+    """
+    Compact, fixed-field form of a successful get_status() result, for jobs
+    that hold many results in memory before writing them.
+
+    Attributes:
+        pro, status, longstatus, delivery_date, delivery_time - from the
+            get_status() result
+        scac - prefix for the stored pro; the carrier the status was
+            requested with if provided, else the scac from the result
+    """
+
+    __slots__ = _STATUS_FIELDS
+
+    def __init__(
+        self, pro, scac, status, longstatus, delivery_date, delivery_time
+    ):
+        self.pro = pro
+        self.scac = scac
+        self.status = status
+        self.longstatus = longstatus
+        self.delivery_date = delivery_date
+        self.delivery_time = delivery_time
+
+    @classmethod
+    def from_status(cls, status: dict, scac_or_carrier_id=None):
+        return cls(*_status_values(status, scac_or_carrier_id))
+
+    def to_params(self) -> tuple:
+        """
+        Returns (pro, status, longstatus, delivery_time, delivery_date) as
+        stored in known_shipments by get_status_to_db(), for
+        insert_statuses().
+        """
+        return (
+            f"{self.scac}-{self.pro}",
+            self.status,
+            self.longstatus,
+            self.delivery_time,
+            self.delivery_date,
+        )
+
+
+class StatusBatch:
+    """
+    Column-oriented container of successful get_status() results, one list
+    per field of StatusRecord, which uses less memory than a list of
+    records for large batches.
+    """
+
+    def __init__(self):
+        for field in _STATUS_FIELDS:
+            setattr(self, field, [])
+
+    def __len__(self) -> int:
+        return len(self.pro)
+
+    def append(self, status: dict, scac_or_carrier_id=None):
+        """
+        Args:
+            status - successful get_status() result
+            scac_or_carrier_id - the carrier the status was requested with,
+                used to prefix the stored pro like get_status_to_db()
+        """
+        for field, value in zip(
+            _STATUS_FIELDS, _status_values(status, scac_or_carrier_id)
+        ):
+            getattr(self, field).append(value)
+
+    def __iter__(self):
+        # StatusRecords, created on demand
+        for values in zip(*(getattr(self, field) for field in _STATUS_FIELDS)):
+            yield StatusRecord(*values)
+
+    def to_params(self):
+        """
+        Yields (pro, status, longstatus, delivery_time, delivery_date) for
+        each result, as for StatusRecord.to_params().
+        """
+        columns = zip(
+            self.scac,
+            self.pro,
+            self.status,
+            self.longstatus,
+            self.delivery_time,
+            self.delivery_date,
+        )
+        for scac, pro, *values in columns:
+            yield (f"{scac}-{pro}", *values)
+
+
+def get_status_record(
+    pro: str, scac_or_carrier_id: Union[str, int] = "LN"
+) -> Union[StatusRecord, dict]:
+    """
+    As get_status(), but successful results are returned as a StatusRecord.
+    Errors are returned as the {"errors": [...]} dictionary.
+    """
+    status = get_status(pro, scac_or_carrier_id)
+    if "errors" in status:
+        return status
+    return StatusRecord.from_status(status, scac_or_carrier_id)
+
+
+def insert_statuses(conn, records) -> int:
+    """
+    Args:
+        conn - sqlite3 connection object
+        records - StatusBatch, or iterable of StatusRecords
+
+    Inserts all results into known_shipments with one executemany() and
+    one commit.
+
+    Returns:
+        Number of rows inserted
+    """
+    if isinstance(records, StatusBatch):
+        params = list(records.to_params())
+    else:
+        params = [record.to_params() for record in records]
+    with _phase("db"):
+        conn.executemany(
+            """
+            INSERT INTO known_shipments(
+                pro, status, longstatus, delivery_time, delivery_date
+            )
+            VALUES (?, ?, ?, ?, ?)
+        """,
+            params,
+        )
+        conn.commit()
+    for row in params:
+        _remember_known_ref(conn, row[0])
+    return len(params)
+
+
+def benchmark_status_memory(count: int = 100000) -> dict:
+    """
+    Args:
+        count - number of results to hold in memory
+
+    Measures the memory used to hold count get_status() results as
+    dictionaries (from json.loads(), as get_status() returns them), as
+    StatusRecords, and as one StatusBatch. No API calls are made. Run via:
+
+        >>> import doc_client
+        >>> doc_client.benchmark_status_memory()
+
+    Returns:
+        {"dict": bytes, "record": bytes, "batch": bytes}
+    """
+    statuses = ["DELIVERED", "IN_TRANSIT", "OUT_FOR_DELIVERY"]
+
+    def results():
+        for i in range(count):
+            status = statuses[i % len(statuses)]
+            yield json.dumps(
+                {
+                    "delivery_date": "2024-06-%02d" % (i % 28 + 1),
+                    "delivery_time": "%02d:%02d" % (i % 24, i % 60),
+                    "status": status,
+                    "longstatus": status.replace("_", " ").title(),
+                    "scac": "LN",
+                    "pro": str(1000000 + i),
+                }
+            )
+
+    def measure(build):
+        tracemalloc.start()
+        try:
+            held = build()
+            size = tracemalloc.get_traced_memory()[0]
+            del held
+        finally:
+            tracemalloc.stop()
+        return size
+
+    def build_batch():
+        batch = StatusBatch()
+        for result in results():
+            batch.append(json.loads(result), "LN")
+        return batch
+
+    return {
+        "dict": measure(lambda: [json.loads(result) for result in results()]),
+        "record": measure(
+            lambda: [
+                StatusRecord.from_status(json.loads(result), "LN")
+                for result in results()
+            ]
+        ),
+        "batch": measure(build_batch),
+    }
+
+
+# --- read shipments and images back out of the database
+
+
+_SHIPMENT_COLUMNS = (
+    "pro",
+    "status",
+    "longstatus",
+    "delivery_time",
+    "updated_at",
+)
+
+
+def get_shipment(conn, pro: str) -> Union[dict, None]:
+    """
+    Args:
+        conn - sqlite3 connection object
+        pro - the pro as stored in known_shipments, like "LN-12345"
+
+    Returns:
+        {"pro": ..., "status": ..., "longstatus": ..., "delivery_time": ...,
+        "updated_at": ...} or None if the pro is unknown
+    """
+    row = conn.execute(
+        f"""
+        SELECT {','.join(_SHIPMENT_COLUMNS)} FROM known_shipments
+        WHERE pro = ?
+    """,
+        [pro],
+    ).fetchone()
+    return dict(zip(_SHIPMENT_COLUMNS, row)) if row else None
+
+
+def list_shipments(
+    conn, status: str = None, after: tuple = None, limit: int = 100
+) -> tuple:
+    """
+    Args:
+        conn - sqlite3 connection object
+        status - only list shipments with this status
+        after - cursor returned by the previous call, to get the next page
+        limit - maximum number of shipments to return
+
+    Lists shipments in order of updated_at (then pro), using the indexes on
+    those columns instead of OFFSET, so later pages cost the same as the
+    first.
+
+    Returns:
+        (list of shipment dicts as from get_shipment(), cursor for the next
+        page or None if this was the last page)
+    """
+    where = []
+    params = []
+    if status is not None:
+        where.append("status = ?")
+        params.append(status)
+    if after is not None:
+        where.append("(updated_at, pro) > (?, ?)")
+        params.extend(after)
+    query = f"SELECT {','.join(_SHIPMENT_COLUMNS)} FROM known_shipments"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY updated_at, pro LIMIT ?"
+    params.append(limit)
+
+    rows = [
+        dict(zip(_SHIPMENT_COLUMNS, row))
+        for row in conn.execute(query, params)
+    ]
+    cursor = None
+    if len(rows) == limit:
+        cursor = (rows[-1]["updated_at"], rows[-1]["pro"])
+    return rows, cursor
+
+
+class ImageBlob:
+    """
+    Lazy handle to the image_data of one shipment_images row. Nothing is
+    read from the database until .read() or .iter_chunks() is called, and
+    then only the requested bytes are read.
+
+    Attributes:
+        known_pro, image_identifier, updated_at - from the row
+        size - length of the image data in bytes
+
+    rowid can be None, and is looked up on the first read. If the row is
+    replaced meanwhile, by a write through another connection, the new row
+    is found by known_pro and image_identifier.
+    """
+
+    def __init__(
+        self, conn, rowid, known_pro, image_identifier, updated_at, size
+    ):
+        self.conn = conn
+        self.rowid = rowid
+        self.known_pro = known_pro
+        self.image_identifier = image_identifier
+        self.updated_at = updated_at
+        self.size = size or 0
+        self._pos = 0
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, pos: int, whence: int = 0) -> int:
+        base = (0, self._pos, self.size)[whence]
+        self._pos = max(0, min(self.size, base + pos))
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        if self.rowid is None:
+            self._find_row()
+        data = self._read_rowid(size)
+        if data is None:
+            # replaced through another connection since we found it
+            self._find_row()
+            data = self._read_rowid(size)
+            if data is None:
+                raise LookupError(f"image changed while reading: {self!r}")
+        self._pos += len(data)
+        return data
+
+    def _read_rowid(self, size: int) -> Union[bytes, None]:
+        # None if there's no such row, or its data was pruned
+        if size < 0 or self._pos + size > self.size:
+            size = self.size - self._pos
+        if size <= 0:
+            return b""
+        if hasattr(self.conn, "blobopen"):
+            # Python 3.11+ incremental blob I/O
+            try:
+                blob = self.conn.blobopen(
+                    "shipment_images", "image_data", self.rowid, readonly=True
+                )
+            except sqlite3.OperationalError:
+                return None
+            with blob:
+                blob.seek(self._pos)
+                return blob.read(size)
+        row = self.conn.execute(
+            """
+            SELECT substr(image_data, ?, ?)
+            FROM shipment_images
+            WHERE rowid = ? AND image_data IS NOT NULL
+        """,
+            [self._pos + 1, size, self.rowid],
+        ).fetchone()
+        return row and row[0]
+
+    def _find_row(self):
+        row = self.conn.execute(
+            """
+            SELECT rowid, updated_at, length(image_data)
+            FROM shipment_images
+            WHERE known_pro = ? AND image_identifier = ?
+        """,
+            [self.known_pro, self.image_identifier],
+        ).fetchone()
+        if row is None:
+            _forget_image_metadata(self.conn, self.known_pro)
+            raise LookupError(f"image no longer stored: {self!r}")
+        if (self.updated_at, self.size) != (row[1], row[2] or 0):
+            # list_images() metadata for this pro is stale too
+            _forget_image_metadata(self.conn, self.known_pro)
+        self.rowid, self.updated_at, size = row
+        self.size = size or 0
+
+    def __repr__(self) -> str:
+        return f"ImageBlob({self.known_pro!r}, {self.image_identifier!r})"
+
+    def iter_chunks(self, chunk_size: int = 65536):
+        """
+        Yields the image data from the current position in chunks of at most
+        chunk_size bytes.
+        """
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def list_images(conn, known_pro: str) -> list:
+    """
+    Args:
+        conn - sqlite3 connection object
+        known_pro - the pro as stored in known_shipments, like "LN-12345"
+
+    Lists images stored for the shipment without reading their data.
+    With a CachedConnection, metadata is cached per conn (see
+    settings.IMAGE_METADATA_CACHE_SIZE), and refreshed when images are
+    inserted through insert_data() on the same conn.
+
+    Returns:
+        List of ImageBlob handles, ordered by image_identifier
+    """
+    metadata = _conn_cache(
+        _image_metadata_by_conn, conn, settings.IMAGE_METADATA_CACHE_SIZE
+    )
+    rows = metadata.get(known_pro) if metadata is not None else None
+    if rows is None:
+        # no rowids, as writes through other connections replace rows
+        rows = conn.execute(
+            """
+            SELECT known_pro, image_identifier, updated_at, length(image_data)
+            FROM shipment_images
+            WHERE known_pro = ?
+            ORDER BY image_identifier
+        """,
+            [known_pro],
+        ).fetchall()
+        if metadata is not None:
+            metadata.set(known_pro, rows)
+    return [ImageBlob(conn, None, *row) for row in rows]
+
+
+def changes_since(conn, cursor: int = 0, limit: int = 100) -> tuple:
+    """
+    Args:
+        conn - sqlite3 connection object
+        cursor - 0 to start, or the cursor returned by the previous call
+        limit - maximum number of shipments to return
+
+    Lists shipments that were inserted, changed, or received images after
+    the cursor, oldest change first, with one indexed range scan. A
+    shipment changed several times since the cursor is listed once.
+
+    Returns:
+        (list of shipment dicts as from get_shipment(), plus "change_seq",
+        cursor to pass to the next call)
+    """
+    columns = _SHIPMENT_COLUMNS + ("change_seq",)
+    rows = [
+        dict(zip(columns, row))
+        for row in conn.execute(
+            f"""
+            SELECT {','.join(columns)} FROM known_shipments
+            WHERE change_seq > ?
+            ORDER BY change_seq
+            LIMIT ?
+        """,
+            [cursor, limit],
+        )
+    ]
+    return rows, rows[-1]["change_seq"] if rows else cursor
+
+
+def _updated_between(since: str, until: str) -> tuple:
+    where = ["1"]
+    params = []
+    if since:
+        where.append("updated_at >= ?")
+        params.append(since)
+    if until:
+        where.append("updated_at < ?")
+        params.append(until)
+    return " AND ".join(where), params
+
+
+def _export_path(blob: ImageBlob) -> tuple:
+    # keeps stored names from escaping the images directory
+    names = []
+    for name in (blob.known_pro, blob.image_identifier):
+        name = os.path.basename(name or "")
+        names.append(name if name not in ("", ".", "..") else "_")
+    return ("images", *names)
+
+
+def export_data(
+    conn, output: str, since: str = None, until: str = None
+) -> tuple:
+    """
+    Args:
+        conn - sqlite3 connection object
+        output - a filename ending in .tar or .tar.gz, or a directory
+        since - only export rows with updated_at >= since, like "2024-06-01"
+        until - only export rows with updated_at < until
+
+    Writes known_shipments rows as "shipments.jsonl", one JSON object per
+    line, and image data as "images/<known_pro>/<image_identifier>", like
+    "images/LN-12345/12345_1.jpg", so images with the same filename from
+    different carriers or webhooks don't overwrite each other. Rows
+    and image data are streamed in small chunks, so memory use doesn't
+    grow with the size of the database. Pruned images are skipped.
+
+    Returns:
+        (number of shipments, number of images) exported
+    """
+    where, params = _updated_between(since, until)
+    shipments = conn.execute(
+        f"""
+        SELECT {','.join(_SHIPMENT_COLUMNS)} FROM known_shipments
+        WHERE {where} ORDER BY updated_at, pro
+    """,
+        params,
+    )
+    images = conn.execute(
+        f"""
+        SELECT rowid, known_pro, image_identifier, updated_at,
+            length(image_data)
+        FROM shipment_images
+        WHERE image_data IS NOT NULL AND {where}
+        ORDER BY updated_at, known_pro
+    """,
+        params,
+    )
+
+    shipment_count = image_count = 0
+    if output.endswith((".tar", ".tar.gz")):
+        with tarfile.open(
+            output, "w:gz" if output.endswith("gz") else "w"
+        ) as tar:
+            # tar needs the member size up front
+            with tempfile.TemporaryFile() as staged:
+                for row in shipments:
+                    staged.write(
+                        json.dumps(dict(zip(_SHIPMENT_COLUMNS, row))).encode()
+                        + b"\n"
+                    )
+                    shipment_count += 1
+                info = tarfile.TarInfo("shipments.jsonl")
+                info.size = staged.tell()
+                staged.seek(0)
+                tar.addfile(info, staged)
+
+            for row in images:
+                blob = ImageBlob(conn, *row)
+                info = tarfile.TarInfo("/".join(_export_path(blob)))
+                info.size = blob.size
+                tar.addfile(info, blob)
+                image_count += 1
+        return shipment_count, image_count
+
+    os.makedirs(os.path.join(output, "images"), exist_ok=True)
+    with open(os.path.join(output, "shipments.jsonl"), "w") as out:
+        for row in shipments:
+            out.write(json.dumps(dict(zip(_SHIPMENT_COLUMNS, row))) + "\n")
+            shipment_count += 1
+
+    for row in images:
+        blob = ImageBlob(conn, *row)
+        path = os.path.join(output, *_export_path(blob))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as out:
+            for chunk in blob.iter_chunks():
+                out.write(chunk)
+        image_count += 1
+    return shipment_count, image_count
+
+
+# --- prune old image data and return the space to the filesystem
+
+
+def enable_incremental_vacuum(conn):
+    """
+    Args:
+        conn - sqlite3 connection object
+
+    Switches an existing database to auto_vacuum=INCREMENTAL. This runs a
+    full VACUUM, which rewrites the file under an exclusive lock, so only do
+    this once, during a quiet period. Does nothing if already enabled.
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    conn.commit()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+
+def prune_images(
+    conn,
+    max_age_days: int = None,
+    delivered_days: int = None,
+    keep_metadata: bool = True,
+    batch_size: int = 100,
+) -> int:
+    """
+    Args:
+        conn - sqlite3 connection object
+        max_age_days - prune images stored more than this many days ago
+        delivered_days - prune images for shipments with a status in
+            settings.DELIVERED_STATUSES and a delivery_date more than this
+            many days ago; delivery_date is compared as an ISO 8601 string,
+            and rows without one use updated_at instead
+        keep_metadata - if true, only clear image_data, keeping the row for
+            list_images(); otherwise delete the row
+        batch_size - maximum number of images to prune
+
+    Prunes up to batch_size images matching either limit, committing once.
+    Keep batches small to keep the write lock short.
+
+    Returns:
+        Number of images pruned
+    """
+    # one query per limit, so each can use its index on unpruned images
+    queries = []
+    if max_age_days is not None:
+        queries.append(
+            (
+                "updated_at < datetime('now', ?)",
+                [f"-{max_age_days} days"],
+            )
+        )
+    if delivered_days is not None:
+        cutoff = datetime.datetime.now(
+            datetime.timezone.utc
+        ) - datetime.timedelta(days=delivered_days)
+        statuses = ",".join(len(settings.DELIVERED_STATUSES) * ["?"])
+        queries.append(
+            (
+                f"""known_pro IN (
+                    SELECT pro FROM known_shipments
+                    WHERE status IN ({statuses})
+                    AND coalesce(delivery_date, updated_at) < ?
+                )""",
+                [*settings.DELIVERED_STATUSES, cutoff.date().isoformat()],
+            )
+        )
+
+    found = {}  # rowid -> None, as both limits can match the same image
+    for where, params in queries:
+        if len(found) >= batch_size:
+            break
+        for (rowid,) in conn.execute(
+            f"""
+            SELECT rowid FROM shipment_images
+            WHERE image_data IS NOT NULL AND {where}
+            LIMIT ?
+        """,
+            params + [batch_size - len(found)],
+        ):
+            found[rowid] = None
+    if not found:
+        return 0
+    rowids = list(found)
+
+    vals = ",".join(len(rowids) * ["?"])
+    if keep_metadata:
+        query = "UPDATE shipment_images SET image_data = NULL"
+    else:
+        query = "DELETE FROM shipment_images"
+    query += f" WHERE rowid IN ({vals})"
+    conn.execute(query, rowids)
+    conn.commit()
+
+    metadata = _conn_cache(_image_metadata_by_conn, conn)
+    if metadata is not None:
+        metadata.clear()
+    return len(rowids)
+
+
+def incremental_vacuum(conn, pages: int = 100) -> int:
+    """
+    Args:
+        conn - sqlite3 connection object
+        pages - maximum number of free pages to return to the filesystem
+
+    Returns free pages from the end of the database file, when the database
+    uses auto_vacuum=INCREMENTAL. Each call holds the write lock only long
+    enough to move the given number of pages.
+
+    Returns:
+        Number of free pages left in the database
+    """
+    # each step of this pragma frees one page; executescript() steps it to
+    # completion, where execute() would stop after the first page
+    conn.commit()
+    conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def start_retention(
+    sqlite_file: str,
+    max_age_days: int = None,
+    delivered_days: int = None,
+    keep_metadata: bool = True,
+    interval: float = 3600.0,
+    batch_size: int = 100,
+    pause: float = 0.5,
+    vacuum_pages: int = 100,
+):
+    """
+    Args:
+        sqlite_file - sqlite file to prune
+        max_age_days, delivered_days, keep_metadata, batch_size - as for
+            prune_images()
+        interval - seconds to wait before looking for more images to prune
+            once we have caught up
+        pause - seconds to wait between batches, to leave the database to
+            other writers
+        vacuum_pages - pages to vacuum after each batch
+
+    Starts a daemon thread that alternates prune_images() and
+    incremental_vacuum() using its own connection.
+
+    Returns:
+        (thread, stop_event); call stop_event.set() then thread.join() to
+        stop after the current batch
+    """
+    stop = threading.Event()
+
+    def run():
+        conn = CachedConnection(sqlite_file)
+        try:
+            while not stop.is_set():
+                pruned = prune_images(
+                    conn,
+                    max_age_days,
+                    delivered_days,
+                    keep_metadata,
+                    batch_size,
+                )
+                free = incremental_vacuum(conn, vacuum_pages)
+                stop.wait(pause if pruned or free else interval)
+        finally:
+            conn.close()
+
+    thread = threading.Thread(target=run, name="retention", daemon=True)
+    thread.start()
+    return thread, stop
+
+
+# --- spread writes over multiple sqlite files
+
+
+def shard_for(known_pro: str, shard_count: int) -> int:
+    """
+    Args:
+        known_pro - the pro as stored in known_shipments, like "LN-12345",
+            or the ref of a webhook request
+        shard_count - how many shards there are
+
+    Returns the index of the shard that stores known_pro. Stable across
+    processes and Python versions, unlike hash().
+    """
+    return zlib.crc32(known_pro.encode()) % shard_count
+
+
+def shard_files(sqlite_file: str, shard_count: int) -> list:
+    """
+    Args:
+        sqlite_file - database filename, like "finalmile_test.sqlite3"
+        shard_count - how many shards there are
+
+    Returns:
+        List of shard filenames, like "finalmile_test.0.sqlite3", or
+        [sqlite_file] for a single shard
+    """
+    if shard_count <= 1:
+        return [sqlite_file]
+    base, ext = os.path.splitext(sqlite_file)
+    return [f"{base}.{i}{ext}" for i in range(shard_count)]
 
 
-def get_status_to_db(
-    conn, pro: str, scac_or_carrier_id: Union[str, int] = "LN"
-) -> dict:
+def open_shards(sqlite_file: str, shard_count: int) -> list:
     """
     Args:
-        conn - sqlite3 connection object
-        pro - pro to get images for
-        scac_or_carrier_id - which carrier to use, either a 4-letter SCAC,
-            LN, or the carrier_id shown on the Carrier Credentials page;
-            defaults to "LN" for Liminal Network Final Mile Photos service
+        sqlite_file - database filename, like "finalmile_test.sqlite3"
+        shard_count - how many shards there are
 
-    Inserts the status metadata for the given pro into the database specified,
-    into the table named known_shipments. On error will not change the DB.
+    Opens and applies the schema to each shard.
 
     Returns:
-        get_status() call results for testing / verification
+        List of connections, indexed by shard_for()
     """
-    status = get_status(pro, scac_or_carrier_id)
-    if "errors" in status:
-        return status
-    to_insert = {
-        k: status[k] for k in ("pro", "status", "longstatus", "delivery_time")
-    }
-    to_insert["pro"] = str(scac_or_carrier_id) + "-" + to_insert["pro"]
-    insert_data(conn, "known_shipments", to_insert)
-    return status
+    conns = []
+    for filename in shard_files(sqlite_file, shard_count):
+        conn = CachedConnection(filename)
+        setup_schema(conn)
+        conns.append(conn)
+    return conns
 
 
-def get_images_to_db(
-    conn, pro: str, scac_or_carrier_id: Union[str, int] = "LN"
-):
+def shard_conn(conns: list, known_pro: str):
     """
     Args:
-        conn - sqlite3 connection object
-        pro - pro to get images for
-        scac_or_carrier_id - which carrier to use, either a 4-letter SCAC,
-            LN, or the carrier_id shown on the Carrier Credentials page;
-            defaults to "LN" for Liminal Network Final Mile Photos service
+        conns - shard connections as returned by open_shards()
+        known_pro - the pro as stored in known_shipments, or a webhook ref
 
-    Inserts all images for the given pro into the database specified,
-    into the table named shipment_images.
+    Returns the connection for the shard that stores known_pro.
     """
-    identifier = f"{scac_or_carrier_id}-{pro}"
-    for image_name in get_individual_images(
-        pro, "proof", (), scac_or_carrier_id
-    ):
-        try:
-            with open(image_name, "rb") as img:
-                # If you wanted to use an object store instead,
-                # change this code.
-                img_data = img.read()
-                to_insert = {
-                    "known_pro": identifier,
-                    "image_identifier": image_name,
-                    "image_data": img_data,
-                }
-                insert_data(conn, "shipment_images", to_insert)
-        except FileNotFoundError:
-            print(image_name, os.getcwd(), os.listdir("."))
-            raise
+    return conns[shard_for(known_pro, len(conns))]
+
+
+def _apply_settings(values: dict):
+    # pool initializer; processes started by spawn or forkserver re-import
+    # this module, and would otherwise miss settings changed at runtime,
+    # like API keys and timeouts from the command line
+    for name, value in values.items():
+        setattr(settings, name, value)
+
+
+def _shard_pool(workers: int, mp_context=None):
+    values = {
+        name: value for name, value in vars(settings).items() if name.isupper()
+    }
+    return concurrent.futures.ProcessPoolExecutor(
+        workers,
+        mp_context=mp_context,
+        initializer=_apply_settings,
+        initargs=(values,),
+    )
+
 
-        # remember to delete the local temporary file
-        os.unlink(image_name)
+def _sync_shard(
+    filename: str,
+    pros: list,
+    scac_or_carrier_id: Union[str, int],
+    expires_at: float = None,
+) -> dict:
+    # runs in a worker process, the only writer for its shard; expires_at is
+    # by time.time(), as monotonic clocks aren't shared between processes
+    conn = CachedConnection(filename)
+    try:
+        setup_schema(conn)
+        budget = None
+        if expires_at is not None:
+            budget = max(expires_at - time.time(), 0.0)
+        return get_many_to_db(conn, pros, scac_or_carrier_id, Deadline(budget))
+    finally:
+        conn.close()
 
 
-def get_all_to_db(conn, pro: str, scac_or_carrier_id: Union[str, int] = "LN"):
+def sync_sharded(
+    sqlite_file: str,
+    shard_count: int,
+    pros: list,
+    scac_or_carrier_id: Union[str, int] = "LN",
+    budget: float = None,
+) -> dict:
     """
     Args:
-        conn - sqlite3 connection object
-        pro - pro to get status and images for
+        sqlite_file - database filename, like "finalmile_test.sqlite3"
+        shard_count - how many shards there are
+        pros - pros to get status and images for
         scac_or_carrier_id - which carrier to use, either a 4-letter SCAC,
             LN, or the carrier_id shown on the Carrier Credentials page;
             defaults to "LN" for Liminal Network Final Mile Photos service
+        budget - optional seconds for the whole sync, shared by the shards
 
-    Will call get_status_to_db(), and if the status is one to expect images,
-    will subsequently call get_images_to_db().
+    Calls get_many_to_db() for the pros of each shard, with one worker
+    process per shard, so shards are written in parallel. Workers use this
+    process's settings, including any changed since import.
+
+    Returns:
+        get_many_to_db() results, combined across shards
+    """
+    files = shard_files(sqlite_file, shard_count)
+    by_shard = {}
+    for pro in pros:
+        shard = shard_for(f"{scac_or_carrier_id}-{pro}", len(files))
+        by_shard.setdefault(shard, []).append(pro)
+    results = {"done": [], "errors": {}, "unfinished": [], "partial": {}}
+    if not by_shard:
+        return results
+
+    expires_at = None if budget is None else time.time() + budget
+    with _shard_pool(len(by_shard)) as pool:
+        futures = [
+            pool.submit(
+                _sync_shard,
+                files[shard],
+                shard_pros,
+                scac_or_carrier_id,
+                expires_at,
+            )
+            for shard, shard_pros in by_shard.items()
+        ]
+        for fut in futures:
+            shard_results = fut.result()
+            for key, value in shard_results.items():
+                if isinstance(value, list):
+                    results[key].extend(value)
+                else:
+                    results[key].update(value)
+    return results
+
+
+def query_shards(conns: list, query: str, params=(), key=None):
+    """
+    Args:
+        conns - shard connections as returned by open_shards()
+        query - SELECT to run against every shard
+        params - query parameters
+        key - if the query has an ORDER BY, a function returning the same
+            ordering from a result row, to merge the shards in order
+
+    Runs the query against every shard, yielding rows one at a time. Rows
+    are merged by key if provided, otherwise shard by shard.
     """
-    status = get_status_to_db(conn, pro, scac_or_carrier_id)
-    if "errors" not in status:
-        # can try to get any uploaded images any time there isn't an error
-        get_images_to_db(conn, pro, scac_or_carrier_id)
+    cursors = [conn.execute(query, params) for conn in conns]
+    if key is None:
+        for cursor in cursors:
+            yield from cursor
+    else:
+        yield from heapq.merge(*cursors, key=key)
 
 
 # --- handle webhook requests generically
@@ -502,13 +2580,18 @@ def handle_request(
     request_body: Union[str, bytes],
     body_base64_encoded: bool,
     body_json_encoded: bool,
+    event_log=None,
 ) -> str:
     """
     Args:
-        conn - database connection
+        conn - database connection, or list of shard connections from
+            open_shards() to route the request by its ref
         request_body - the body of the http(s) request
         body_base64_encoded - true if the body was base64 encoded, and must be decoded
         body_json_encoded - true if the body was json encoded, otherwise was x-www-form-urlencoded
+        event_log - optional connection set up with setup_event_log(); if
+            provided, the decoded request is only appended to the log, to be
+            applied later by materialize_events(), and conn is not used
 
     Handles "start", "status", "image", and "end" webhook requests, inserting their results into
     our demonstration sqlite db.
@@ -522,6 +2605,38 @@ def handle_request(
         "error-..."
 
     """
+    with _phase("decode"):
+        post_data = _decode_request(
+            request_body, body_base64_encoded, body_json_encoded
+        )
+
+    for it in ("ref", "what"):
+        if not post_data.get(it):
+            return f"error-{it}"
+
+    ref = post_data.get("ref")[0]
+    what = post_data.get("what")[0]
+    now_dt = datetime.datetime.now(datetime.timezone.utc)
+    now = now_dt.replace(microsecond=0, tzinfo=None).isoformat()
+    now += "+0000"
+
+    if isinstance(conn, list):
+        conn = shard_conn(conn, ref)
+
+    if event_log is not None:
+        if what not in ("start", "status", "image", "end"):
+            return "error-unknown-" + what
+        append_event(event_log, post_data, now, ref, what)
+        return "ok"
+
+    return _dispatch(conn, post_data, now, ref, what)
+
+
+def _decode_request(
+    request_body: Union[str, bytes],
+    body_base64_encoded: bool,
+    body_json_encoded: bool,
+) -> dict:
     # decode the post body
     if body_base64_encoded:
         request_body = base64.b64decode(
@@ -539,21 +2654,11 @@ def handle_request(
     # parse the post body
     if body_json_encoded:
         # for compat with parse_qs()
-        post_data = {k: [v] for k, v in json.loads(body).items()}
-    else:
-        post_data = urllib.parse.parse_qs(body)
-
-    for it in ("ref", "what"):
-        if not post_data.get(it):
-            return f"error-{it}"
+        return {k: [v] for k, v in json.loads(body).items()}
+    return urllib.parse.parse_qs(body)
 
-    ref = post_data.get("ref")[0]
-    what = post_data.get("what")[0]
-    now_dt = datetime.datetime.now(datetime.timezone.utc)
-    now = now_dt.replace(microsecond=0, tzinfo=None).isoformat()
-    now += "+0000"
 
-    # dispatch
+def _dispatch(conn, post_data: dict, now: str, ref: str, what: str) -> str:
     if what == "start":
         handle_start(conn, now, ref)
         return "ok"
@@ -580,22 +2685,29 @@ def handle_start(conn, now: str, ref: str):
 
     Ensures that ref is represented in known_shipments. If not,
     will add the row with status of QR_SCANNED.
+
+    With a CachedConnection, refs already seen for this conn are remembered
+    in memory (see settings.KNOWN_REFS_CACHE_SIZE), and skip the database
+    entirely.
     """
-    exist_query = "SELECT pro FROM known_shipments WHERE pro = ?"
-    if list(conn.execute(exist_query, [ref])):
+    known = _known_refs(conn)
+    if known is not None and ref in known:
         # don't re-insert
         return
 
-    insert_data(
-        conn,
-        "known_shipments",
-        {
-            "pro": ref,
-            "status": "QR_SCANNED",
-            "longstatus": "QR Code was scanned",
-            "delivery_time": now,
-        },
-    )
+    # an existing row is left alone
+    with _phase("db"):
+        conn.execute(
+            """
+            INSERT INTO known_shipments(pro, status, longstatus, delivery_time)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(pro) DO NOTHING
+        """,
+            [ref, "QR_SCANNED", "QR Code was scanned", now],
+        )
+        conn.commit()
+    if known is not None:
+        known.set(ref)
 
 
 def handle_status(conn, post_data: dict, now: str, ref: str):
@@ -617,6 +2729,7 @@ def handle_status(conn, post_data: dict, now: str, ref: str):
             "status": post_data["status"][0],
             "longstatus": post_data["longstatus"][0],
             "delivery_time": post_data["delivery_date"][0],
+            "delivery_date": post_data["delivery_date"][0],
         },
     )
 
@@ -653,7 +2766,10 @@ def handle_image(conn, post_data: dict, now: str, ref: str) -> str:
 
     try:
         if ";base64," in image[:25]:
-            image_bytes = base64.b64decode(image.partition(",")[-1].encode())
+            with _phase("decode"):
+                image_bytes = base64.b64decode(
+                    image.partition(",")[-1].encode()
+                )
     except Exception:
         # POST body should support at least up to 418,000 bytes to
         # receive image data. If your platform encodes base64 as handled
@@ -705,16 +2821,247 @@ def handle_end(conn, post_data: dict, now: str, ref: str) -> str:
     handle_start(conn, now, ref)
 
     # update the row
-    conn.execute(
+    with _phase("db"):
+        conn.execute(
+            """
+            UPDATE known_shipments
+            SET status = ?, longstatus = ?
+            WHERE pro = ?
+        """,
+            [status, longstatus, ref],
+        )
+        conn.commit()
+    return "ok"
+
+
+# --- append-only webhook event log, applied to the database in batches
+
+
+def setup_event_log(log_conn):
+    """
+    Args:
+        log_conn - sqlite connection for the event log, which can be the same
+            as the database connection, or a separate file on a faster disk
+
+    Applies the event log ddl to the given log_conn.
+    """
+    # appends are sequential; WAL avoids rewriting pages on every commit
+    log_conn.execute("PRAGMA journal_mode = WAL")
+    ddl = [
         """
-        UPDATE known_shipments
-        SET status = ?, longstatus = ?
-        WHERE pro = ?
+        CREATE TABLE IF NOT EXISTS webhook_events(
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            received_at TEXT,
+            ref TEXT,
+            what TEXT,
+            post_data TEXT
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS webhook_event_offsets(
+            consumer TEXT PRIMARY KEY,
+            seq INTEGER
+        );
+        """,
+    ]
+    for d_i in ddl:
+        log_conn.execute(d_i)
+        log_conn.commit()
+
+
+def append_event(log_conn, post_data: dict, now: str, ref: str, what: str):
+    """
+    Args:
+        log_conn - connection set up with setup_event_log()
+        post_data - {"name": ["val"], ...}
+        now - utcnow string
+        ref - pro, tracking, or reference number for the shipment
+        what - one of "start", "status", "image", or "end"
+
+    Appends the decoded webhook request to the event log with one insert
+    and one commit.
+    """
+    log_conn.execute(
+        """
+        INSERT INTO webhook_events(received_at, ref, what, post_data)
+        VALUES (?, ?, ?, ?)
     """,
-        [status, longstatus, ref],
+        [now, ref, what, json.dumps(post_data)],
     )
-    conn.commit()
-    return "ok"
+    log_conn.commit()
+
+
+class _CommitLater:
+    # passed to the handle_*() functions in place of conn, so a whole batch
+    # of events is applied in one transaction
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, *args):
+        return self.conn.execute(*args)
+
+    def commit(self):
+        pass
+
+
+def materialize_events(
+    log_conn, conn, batch_size: int = 500, consumer: str = "default"
+) -> int:
+    """
+    Args:
+        log_conn - connection set up with setup_event_log()
+        conn - database connection set up with setup_schema(); can be the
+            same connection as log_conn
+        batch_size - maximum number of events to apply
+        consumer - name to track our offset in the log under
+
+    Applies up to batch_size events logged after this consumer's offset to
+    conn, in the order they were received, committing once for the batch.
+    The offset is stored in the log, in the same transaction as the batch
+    when log_conn is conn, so after a crash we resume from the last
+    committed batch. If log_conn and conn are separate databases, a crash
+    between their commits re-applies that batch, which results in the same
+    rows.
+
+    Events that fail to apply, including with an sqlite3 error other than
+    sqlite3.OperationalError, are reported and skipped. OperationalErrors
+    like a locked database roll back the batch and are raised, so the batch
+    is retried by the next call.
+
+    Returns:
+        Number of events read from the log
+    """
+    row = log_conn.execute(
+        "SELECT seq FROM webhook_event_offsets WHERE consumer = ?", [consumer]
+    ).fetchone()
+    offset = row[0] if row else 0
+    events = log_conn.execute(
+        """
+        SELECT seq, received_at, ref, what, post_data
+        FROM webhook_events
+        WHERE seq > ?
+        ORDER BY seq
+        LIMIT ?
+    """,
+        [offset, batch_size],
+    ).fetchall()
+    if not events:
+        return 0
+
+    batch = _CommitLater(conn)
+    set_offset = """
+        INSERT OR REPLACE INTO webhook_event_offsets(consumer, seq)
+        VALUES (?, ?)
+    """
+    try:
+        if not conn.in_transaction:
+            # so releasing the savepoint below doesn't commit
+            conn.execute("BEGIN")
+        for seq, now, ref, what, post_data in events:
+            # undoes just this event if it fails part way through
+            conn.execute("SAVEPOINT webhook_event")
+            try:
+                resp = _dispatch(batch, json.loads(post_data), now, ref, what)
+            except sqlite3.OperationalError:
+                raise
+            except Exception as err:
+                conn.execute("ROLLBACK TO webhook_event")
+                # in case handle_start() inserted ref before the failure
+                _forget_known_ref(conn, ref)
+                resp = f"error-{type(err).__name__}"
+            conn.execute("RELEASE webhook_event")
+            if resp != "ok":
+                print("skipped webhook event", seq, what, ref, resp)
+        if log_conn is conn:
+            conn.execute(set_offset, [consumer, events[-1][0]])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        # refs inserted in this batch are no longer known
+        _forget_conn_cache(_known_refs_by_conn, conn)
+        raise
+
+    if log_conn is not conn:
+        log_conn.execute(set_offset, [consumer, events[-1][0]])
+        log_conn.commit()
+    return len(events)
+
+
+def trim_events(log_conn) -> int:
+    """
+    Args:
+        log_conn - connection set up with setup_event_log()
+
+    Deletes the events that every consumer has already applied, as the log
+    holds the full request data, images included. Consumers that have never
+    called materialize_events() aren't waited on.
+
+    Returns:
+        Number of events deleted
+    """
+    row = log_conn.execute(
+        "SELECT min(seq) FROM webhook_event_offsets"
+    ).fetchone()
+    if row[0] is None:
+        return 0
+    deleted = log_conn.execute(
+        "DELETE FROM webhook_events WHERE seq <= ?", [row[0]]
+    ).rowcount
+    log_conn.commit()
+    return deleted
+
+
+def start_materializer(
+    event_log_file: str,
+    sqlite_file: str,
+    interval: float = 1.0,
+    batch_size: int = 500,
+):
+    """
+    Args:
+        event_log_file - sqlite file holding the event log
+        sqlite_file - sqlite file to apply events to; can be the same file
+        interval - seconds to wait before checking for new events once we
+            have caught up
+        batch_size - number of events to apply per transaction
+
+    Starts a daemon thread that applies events from the log to the database
+    using its own connections, trimming applied events from the log as it
+    goes. Database errors are reported, and the batch retried after
+    interval seconds.
+
+    Returns:
+        (thread, stop_event); call stop_event.set() then thread.join() to
+        stop after the current batch
+    """
+    stop = threading.Event()
+
+    def run():
+        conn = CachedConnection(sqlite_file)
+        log_conn = conn
+        if event_log_file != sqlite_file:
+            log_conn = sqlite3.Connection(event_log_file)
+        try:
+            setup_schema(conn)
+            setup_event_log(log_conn)
+            while not stop.is_set():
+                try:
+                    count = materialize_events(log_conn, conn, batch_size)
+                    if count:
+                        trim_events(log_conn)
+                except sqlite3.Error as err:
+                    print("materializer error, will retry:", repr(err))
+                    count = 0
+                if count < batch_size:
+                    stop.wait(interval)
+        finally:
+            if log_conn is not conn:
+                log_conn.close()
+            conn.close()
+
+    thread = threading.Thread(target=run, name="materializer", daemon=True)
+    thread.start()
+    return thread, stop
 
 
 def main():
@@ -762,11 +3109,73 @@ def main():
         default="",
         help="call the /webhook endpoint and register the provided email address",
     )
+    parser.add_argument(
+        "--packed",
+        default=False,
+        action="store_true",
+        help="With --files, append to a few large segment files in --dirname instead of one file per status and image",
+    )
     parser.add_argument(
         "--sqlite-file",
         default="finalmile_test.sqlite3",
         help="Sqlite database to store our data to",
     )
+    parser.add_argument(
+        "--connect-timeout",
+        default=settings.CONNECT_TIMEOUT,
+        type=float,
+        help="Seconds to wait for each API connection",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        default=settings.READ_TIMEOUT,
+        type=float,
+        help="Seconds to wait for each read from an API connection",
+    )
+    parser.add_argument(
+        "--budget",
+        default=None,
+        type=float,
+        help="With --database, seconds for the whole sync; pros not done in time are reported",
+    )
+    parser.add_argument(
+        "--shards",
+        default=1,
+        type=int,
+        help="Spread the database over this many sqlite files, named after --sqlite-file, syncing each in its own process",
+    )
+    parser.add_argument(
+        "--event-log",
+        default="",
+        help="Sqlite file for the webhook event log; with --dispatch, only append the request to the log (see --materialize)",
+    )
+    parser.add_argument(
+        "--since",
+        default=None,
+        help="With --export, only export rows updated at or after this time, like 2024-06-01",
+    )
+    parser.add_argument(
+        "--until",
+        default=None,
+        help="With --export, only export rows updated before this time",
+    )
+    parser.add_argument(
+        "--profile",
+        default=False,
+        action="store_true",
+        help="Print the time spent on network, decode, database, and file phases per pro or request at exit",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default="",
+        help="With --profile, also write cProfile and tracemalloc snapshots to this directory",
+    )
+    parser.add_argument(
+        "--profile-top",
+        default=10,
+        type=int,
+        help="With --profile, how many of the slowest items, functions, and allocation sites to print",
+    )
     parser.add_argument(
         "--dirname",
         default=tempfile.gettempdir(),
@@ -799,6 +3208,17 @@ def main():
         "--dispatch",
         help="The filename of the json-encoded file with [request_body, is_base64_encoded, is_json] stored inside for dispatching via handle_request() (requires --database)",
     )
+    group2.add_argument(
+        "--materialize",
+        default=False,
+        action="store_true",
+        help="Apply all events from --event-log to the database (requires --database)",
+    )
+    group2.add_argument(
+        "--export",
+        default="",
+        help="Export the database to this .tar, .tar.gz, or directory (requires --database, see --since and --until)",
+    )
     group2.add_argument(
         "pro",
         nargs="*",
@@ -813,6 +3233,30 @@ def main():
         print("--dispatch requires --database")
         return exit(1)
 
+    settings.CONNECT_TIMEOUT = args.connect_timeout
+    settings.READ_TIMEOUT = args.read_timeout
+
+    if args.materialize and not (args.database and args.event_log):
+        print("--materialize requires --database and --event-log")
+        return exit(1)
+
+    if args.export and not args.database:
+        print("--export requires --database")
+        return exit(1)
+
+    if args.export and args.shards > 1:
+        print("Can't use --export and --shards together")
+        return exit(1)
+
+    if args.materialize and args.shards > 1:
+        print("Can't use --materialize and --shards together")
+        return exit(1)
+
+    if args.profile and args.shards > 1 and not args.dispatch:
+        # pros are fetched in worker processes, which don't report back
+        print("Can't use --profile and --shards together without --dispatch")
+        return exit(1)
+
     if args.sign:
         if args.dispatch:
             print("Can't use --sign and --dispatch together")
@@ -855,6 +3299,16 @@ def main():
         if args.verbose:
             print("Used API Key from", args.creds)
 
+    if args.profile:
+        start_profiling()
+        if args.profile_dir:
+            import cProfile
+
+            os.makedirs(args.profile_dir, exist_ok=True)
+            tracemalloc.start()
+            profiler = cProfile.Profile()
+            profiler.enable()
+
     # output to files
     cwd = os.getcwd()
     try:
@@ -862,8 +3316,11 @@ def main():
         if args.database:
             if args.verbose:
                 print("Opening database and ensuring schema validity")
-            sq_conn = sqlite3.Connection(args.sqlite_file)
-            setup_schema(sq_conn)
+            if args.shards > 1:
+                shard_conns = open_shards(args.sqlite_file, args.shards)
+            else:
+                sq_conn = CachedConnection(args.sqlite_file)
+                setup_schema(sq_conn)
 
         if args.dispatch:
             if args.verbose:
@@ -875,18 +3332,81 @@ def main():
                     inp.seek(0)
                     print("dispatching:", inp.read(60), "...")
 
-            resp = handle_request(sq_conn, body, is_base64, is_json)
+            log_conn = None
+            if args.event_log:
+                log_conn = sqlite3.Connection(args.event_log)
+                setup_event_log(log_conn)
+
+            with _profile_item(args.dispatch):
+                if args.shards > 1:
+                    resp = handle_request(
+                        shard_conns, body, is_base64, is_json, log_conn
+                    )
+                else:
+                    resp = handle_request(
+                        sq_conn, body, is_base64, is_json, log_conn
+                    )
+            if args.shards > 1:
+                for conn in shard_conns:
+                    conn.close()
+            else:
+                sq_conn.close()
             print("Response to request data:", resp)
+            if log_conn is not None:
+                log_conn.close()
+            return
+
+        elif args.materialize:
+            log_conn = sqlite3.Connection(args.event_log)
+            setup_event_log(log_conn)
+            applied = 0
+            while True:
+                count = materialize_events(log_conn, sq_conn)
+                if not count:
+                    break
+                applied += count
+            trimmed = trim_events(log_conn)
+            if args.verbose:
+                print("Applied", applied, "events from", args.event_log)
+                print("Trimmed", trimmed, "applied events from the log")
+            log_conn.close()
             sq_conn.close()
             return
 
-        elif args.database:
-            for pro in args.pro:
-                if args.verbose:
-                    print("Fetching", pro)
-                get_all_to_db(sq_conn, pro, args.scac)
+        elif args.export:
+            shipments, images = export_data(
+                sq_conn, args.export, args.since, args.until
+            )
+            if args.verbose:
+                print("Exported", shipments, "shipments and", images, "images")
+            sq_conn.close()
+            return
+
+        elif args.database and args.shards > 1:
+            for conn in shard_conns:
+                conn.close()
+            if args.verbose:
+                print(
+                    "Fetching",
+                    len(args.pro),
+                    "pros into",
+                    args.shards,
+                    "shards",
+                )
+            results = sync_sharded(
+                args.sqlite_file, args.shards, args.pro, args.scac, args.budget
+            )
+            _report_sync(args, results)
+            return
 
+        elif args.database:
+            if args.verbose:
+                print("Fetching", len(args.pro), "pros")
+            results = get_many_to_db(
+                sq_conn, args.pro, args.scac, Deadline(args.budget)
+            )
             sq_conn.close()
+            _report_sync(args, results)
             return
 
         elif args.sign:
@@ -913,21 +3433,88 @@ def main():
                 )
             return
 
+        if args.packed:
+            store = PackedStore(".")
+            for pro in args.pro:
+                if args.verbose:
+                    print("Fetching", pro)
+                with _profile_item(pro):
+                    status = get_status(pro, args.scac)
+                    if "errors" in status:
+                        if args.verbose:
+                            print("Shipment had error:", status)
+                        continue
+                    store.put_status(pro, status)
+                    for name, data in _fetch_image_data(pro, args.scac):
+                        store.put_image(pro, name, data)
+
+            if store.maybe_compact() and args.verbose:
+                print("Compacted packed store")
+            store.close()
+            return
+
         for pro in args.pro:
             if args.verbose:
                 print("Fetching", pro)
-            status = get_status(pro, args.scac)
-            if "error" not in status:
-                with open(f"{pro}.json", "w") as out:
-                    json.dump(status, out)
+            with _profile_item(pro):
+                status = get_status(pro, args.scac)
+                if "error" not in status:
+                    with _phase("file"), open(f"{pro}.json", "w") as out:
+                        json.dump(status, out)
 
-                get_individual_images(pro, "proof", (), args.scac)
+                    get_individual_images(pro, "proof", (), args.scac)
 
-            elif args.verbose:
-                print("Shipment had error:", status)
+                elif args.verbose:
+                    print("Shipment had error:", status)
 
     finally:
         os.chdir(cwd)
+        if args.profile:
+            _report_profile(args, profiler if args.profile_dir else None)
+
+
+def _report_sync(args, results: dict):
+    if args.verbose:
+        print("Stored:", " ".join(results["done"]))
+        for pro, errors in results["errors"].items():
+            print("Shipment had error:", pro, errors)
+    if results["unfinished"]:
+        print(
+            "Ran out of --budget, unfinished:", " ".join(results["unfinished"])
+        )
+        for pro, partial in results["partial"].items():
+            print("Partial results for", pro, partial)
+
+
+def _report_profile(args, profiler):
+    # prints the --profile summary, and writes and summarizes the
+    # --profile-dir snapshots
+    snapshot = None
+    if profiler is not None:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+    print(_profile.summary(args.profile_top))
+    stop_profiling()
+    if profiler is None:
+        return
+
+    import pstats
+
+    stats_file = os.path.join(args.profile_dir, "doc_client.pstats")
+    profiler.dump_stats(stats_file)
+    print("cProfile stats written to", stats_file)
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(
+        args.profile_top
+    )
+
+    snapshot_file = os.path.join(args.profile_dir, "doc_client.tracemalloc")
+    snapshot.dump(snapshot_file)
+    print("tracemalloc snapshot written to", snapshot_file)
+    print(f"top {args.profile_top} allocation sites:")
+    for stat in snapshot.statistics("lineno")[: args.profile_top]:
+        print(" ", stat)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,675 @@
+import asyncio
+import multiprocessing
+import os
+import sqlite3
+import tarfile
+import threading
+import time
+
+import doc_client
+
+
+def test_single_flight_async_cancel_keeps_other_waiters():
+    flight = doc_client.SingleFlight()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.2)
+        return "done"
+
+    async def run():
+        first = asyncio.create_task(flight.call_async("key", slow))
+        second = asyncio.create_task(flight.call_async("key", slow))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        assert await second == "done"
+        try:
+            await first
+        except asyncio.CancelledError:
+            pass
+        else:
+            raise AssertionError("first waiter was not cancelled")
+
+    asyncio.run(run())
+    assert calls == [1]
+    # the leader finished cleanly and released the key
+    assert flight.call("key", lambda: "again") == "again"
+
+
+def test_single_flight_threads_share_one_call():
+    flight = doc_client.SingleFlight()
+    calls = []
+    results = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.1)
+        return "done"
+
+    threads = [
+        threading.Thread(target=lambda: results.append(flight.call("k", slow)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["done"] * 4
+    assert calls == [1]
+
+
+def test_handle_start_caches_refs_on_demand():
+    conn = doc_client.CachedConnection(":memory:")
+    doc_client.setup_schema(conn)
+    conn.execute(
+        "INSERT INTO known_shipments(pro, status) VALUES ('A', 'DELIVERED')"
+    )
+    conn.commit()
+    # nothing is loaded up front
+    assert len(doc_client._known_refs(conn)) == 0
+    doc_client.handle_start(conn, "now", "A")
+    doc_client.handle_start(conn, "now", "B")
+    assert "A" in doc_client._known_refs(conn)
+    assert "B" in doc_client._known_refs(conn)
+    rows = conn.execute("SELECT pro, status FROM known_shipments ORDER BY pro")
+    assert rows.fetchall() == [("A", "DELIVERED"), ("B", "QR_SCANNED")]
+
+
+def test_handle_start_plain_connection_skips_cache():
+    conn = sqlite3.connect(":memory:")
+    doc_client.setup_schema(conn)
+    doc_client.handle_start(conn, "now", "A")
+    doc_client.handle_start(conn, "now", "A")
+    assert doc_client._known_refs(conn) is None
+    count = conn.execute("SELECT count(*) FROM known_shipments").fetchone()
+    assert count == (1,)
+
+
+def test_materialize_events_skips_bad_event_and_trims_log():
+    conn = doc_client.CachedConnection(":memory:")
+    doc_client.setup_schema(conn)
+    doc_client.setup_event_log(conn)
+    conn.execute(
+        """
+        CREATE TRIGGER reject_bad BEFORE INSERT ON known_shipments
+        WHEN NEW.pro = 'BAD'
+        BEGIN
+            SELECT RAISE(ABORT, 'rejected');
+        END
+    """
+    )
+    for ref in ("A", "BAD", "C"):
+        doc_client.append_event(conn, {}, "now", ref, "start")
+
+    assert doc_client.materialize_events(conn, conn) == 3
+    rows = conn.execute("SELECT pro FROM known_shipments ORDER BY pro")
+    assert rows.fetchall() == [("A",), ("C",)]
+    assert doc_client.materialize_events(conn, conn) == 0
+
+    assert doc_client.trim_events(conn) == 3
+    assert conn.execute("SELECT count(*) FROM webhook_events").fetchone() == (
+        0,
+    )
+
+
+def test_materialize_events_forgets_ref_of_rolled_back_event():
+    conn = doc_client.CachedConnection(":memory:")
+    doc_client.setup_schema(conn)
+    doc_client.setup_event_log(conn)
+    doc_client._known_refs(conn)
+    # not base64, so handle_image() fails after handle_start()
+    image = {"filename": ["R1_1.jpg"], "image": ["data:image/jpeg,abc"]}
+    doc_client.append_event(conn, image, "now", "R1", "image")
+    end = {"longstatus": ["DELIVERED - Delivered"]}
+    doc_client.append_event(conn, end, "now", "R1", "end")
+
+    assert doc_client.materialize_events(conn, conn) == 2
+    rows = conn.execute("SELECT pro, status FROM known_shipments")
+    assert rows.fetchall() == [("R1", "DELIVERED")]
+
+
+def test_list_images_survives_rows_replaced_by_other_connection(tmp_path):
+    filename = str(tmp_path / "images.sqlite3")
+    conn = doc_client.CachedConnection(filename)
+    doc_client.setup_schema(conn)
+    image = {"known_pro": "LN-1", "image_identifier": "1_1.jpg"}
+    doc_client.insert_data(
+        conn, "shipment_images", dict(image, image_data=b"old")
+    )
+    assert [blob.read() for blob in doc_client.list_images(conn, "LN-1")] == [
+        b"old"
+    ]
+
+    other = sqlite3.connect(filename)
+    doc_client.insert_data(
+        other, "shipment_images", dict(image, image_data=b"newer")
+    )
+    other.close()
+
+    # the cached metadata is stale, but reads find the replaced row
+    (blob,) = doc_client.list_images(conn, "LN-1")
+    assert blob.read() == b"newer"
+    assert blob.size == 5
+    (blob,) = doc_client.list_images(conn, "LN-1")
+    assert blob.size == 5
+
+
+def test_prune_images_by_delivery_date():
+    conn = sqlite3.connect(":memory:")
+    doc_client.setup_schema(conn)
+    shipments = [
+        ("LN-old", "2000-01-01"),
+        ("LN-new", "2999-01-01"),
+    ]
+    for pro, delivery_date in shipments:
+        doc_client.insert_data(
+            conn,
+            "known_shipments",
+            {
+                "pro": pro,
+                "status": "DELIVERED",
+                "longstatus": "Delivered",
+                # a time of day, which must not be compared as a date
+                "delivery_time": "14:32",
+                "delivery_date": delivery_date,
+            },
+        )
+        doc_client.insert_data(
+            conn,
+            "shipment_images",
+            {
+                "known_pro": pro,
+                "image_identifier": "1.jpg",
+                "image_data": b"JFIF",
+            },
+        )
+
+    assert doc_client.prune_images(conn, delivered_days=30) == 1
+    rows = conn.execute(
+        "SELECT known_pro, image_data IS NULL FROM shipment_images"
+        " ORDER BY known_pro"
+    )
+    assert rows.fetchall() == [("LN-new", 0), ("LN-old", 1)]
+    assert doc_client.prune_images(conn, delivered_days=30) == 0
+
+
+def test_export_data_keeps_same_named_images_apart(tmp_path):
+    conn = sqlite3.connect(":memory:")
+    doc_client.setup_schema(conn)
+    for known_pro in ("LN-1", "ABCD-1", "1"):
+        doc_client.insert_data(
+            conn,
+            "shipment_images",
+            {
+                "known_pro": known_pro,
+                "image_identifier": "1_1.jpg",
+                "image_data": known_pro.encode(),
+            },
+        )
+
+    output = tmp_path / "export"
+    assert doc_client.export_data(conn, str(output)) == (0, 3)
+    for known_pro in ("LN-1", "ABCD-1", "1"):
+        path = output / "images" / known_pro / "1_1.jpg"
+        assert path.read_bytes() == known_pro.encode()
+
+    assert doc_client.export_data(conn, str(tmp_path / "x.tar")) == (0, 3)
+    with tarfile.open(tmp_path / "x.tar") as tar:
+        names = sorted(tar.getnames())
+    assert names == [
+        "images/1/1_1.jpg",
+        "images/ABCD-1/1_1.jpg",
+        "images/LN-1/1_1.jpg",
+        "shipments.jsonl",
+    ]
+
+
+def test_packed_store_recovers_from_partial_index_line(tmp_path):
+    store = doc_client.PackedStore(str(tmp_path))
+    store.put_status("p1", {"status": "one"})
+    store.close()
+    with open(tmp_path / "index.jsonl", "ab") as index:
+        index.write(b'["statuses", "p9", "", 1, ')
+
+    store = doc_client.PackedStore(str(tmp_path))
+    store.put_status("p2", {"status": "two"})
+    store.put_status("p3", {"status": "three"})
+    store.close()
+
+    store = doc_client.PackedStore(str(tmp_path))
+    assert sorted(store.pros()) == ["p1", "p2", "p3"]
+    assert store.get_status("p2") == {"status": "two"}
+    store.close()
+
+
+def test_packed_store_reopens_latest_segments(tmp_path):
+    for run in range(5):
+        store = doc_client.PackedStore(str(tmp_path))
+        store.put_status(f"p{run}", {"status": run})
+        store.put_image(f"p{run}", "1.jpg", b"JFIF%d" % run)
+        store.close()
+
+    assert sorted(os.listdir(tmp_path)) == [
+        "images-00002.pack",
+        "index.jsonl",
+        "statuses-00001.jsonl",
+    ]
+    store = doc_client.PackedStore(str(tmp_path), segment_size=1)
+    assert [store.get_status(f"p{run}") for run in range(5)] == [
+        {"status": run} for run in range(5)
+    ]
+    assert store.get_image("p4", "1.jpg") == b"JFIF4"
+    # full segments aren't appended to
+    store.put_status("p5", {"status": 5})
+    store.close()
+    assert os.path.exists(tmp_path / "statuses-00003.jsonl")
+
+
+def _insert_shipment(conn, pro, status):
+    doc_client.insert_data(
+        conn,
+        "known_shipments",
+        {"pro": pro, "status": status, "longstatus": status},
+    )
+
+
+def test_changes_since_sees_update_of_most_recent_row():
+    conn = sqlite3.connect(":memory:")
+    doc_client.setup_schema(conn)
+    _insert_shipment(conn, "A", "PICKED_UP")
+    _insert_shipment(conn, "B", "PICKED_UP")
+    rows, cursor = doc_client.changes_since(conn)
+    assert [row["pro"] for row in rows] == ["A", "B"]
+
+    # B holds the highest change_seq, and is replaced on conflict
+    _insert_shipment(conn, "B", "DELIVERED")
+    rows, cursor = doc_client.changes_since(conn, cursor)
+    assert [(row["pro"], row["status"]) for row in rows] == [
+        ("B", "DELIVERED")
+    ]
+    assert doc_client.changes_since(conn, cursor) == ([], cursor)
+
+
+def test_setup_schema_migrates_change_seq_triggers():
+    conn = sqlite3.connect(":memory:")
+    doc_client.setup_schema(conn)
+    # as created before change_counter existed
+    conn.executescript(
+        """
+        DROP TABLE change_counter;
+        DROP TRIGGER known_shipments_insert_change;
+        CREATE TRIGGER known_shipments_insert_change
+        AFTER INSERT ON known_shipments
+        BEGIN
+            UPDATE known_shipments
+            SET change_seq = (
+                SELECT coalesce(max(change_seq), 0) + 1 FROM known_shipments
+            )
+            WHERE rowid = NEW.rowid;
+        END;
+        DROP TRIGGER known_shipments_update_change;
+        DROP TRIGGER shipment_images_insert_change;
+    """
+    )
+    _insert_shipment(conn, "A", "PICKED_UP")
+
+    doc_client.setup_schema(conn)
+    _insert_shipment(conn, "B", "PICKED_UP")
+    _insert_shipment(conn, "B", "DELIVERED")
+    rows = conn.execute("SELECT pro, change_seq FROM known_shipments")
+    assert sorted(rows.fetchall()) == [("A", 1), ("B", 3)]
+
+
+def test_single_flight_follower_retries_on_its_own_deadline():
+    flight = doc_client.SingleFlight()
+    deadlines = []
+    results = {}
+
+    def slow(deadline=None):
+        deadlines.append(deadline)
+        time.sleep(0.2)
+        deadline.check("partial")
+        return "done"
+
+    def leader():
+        try:
+            flight.call("k", slow, deadline=doc_client.Deadline(0.1))
+        except doc_client.DeadlineExceeded as err:
+            results["leader"] = err.partial
+
+    thread = threading.Thread(target=leader)
+    thread.start()
+    time.sleep(0.05)
+    follower = doc_client.Deadline(5)
+    results["follower"] = flight.call("k", slow, deadline=follower)
+    thread.join()
+    assert results == {"leader": "partial", "follower": "done"}
+    assert deadlines[1] is follower
+
+
+def test_refresh_shipment_rollback_forgets_known_ref(monkeypatch):
+    status = {
+        "pro": "1",
+        "status": "DELIVERED",
+        "longstatus": "Delivered",
+        "delivery_time": "14:32",
+    }
+    monkeypatch.setattr(doc_client, "get_status", lambda *args: status)
+    monkeypatch.setattr(
+        doc_client,
+        "_download_images",
+        lambda *args: iter([("1_1.jpg", b"JFIF")]),
+    )
+    monkeypatch.setattr(
+        doc_client, "_download_pdf", lambda *args: ("1.pdf", b"%PDF")
+    )
+    conn = doc_client.CachedConnection(":memory:")
+    doc_client.setup_schema(conn)
+    doc_client.handle_start(conn, "now", "other")
+    conn.execute(
+        """
+        CREATE TRIGGER reject_images BEFORE INSERT ON shipment_images
+        BEGIN
+            SELECT RAISE(ABORT, 'rejected');
+        END
+    """
+    )
+
+    try:
+        doc_client.refresh_shipment(conn, "1")
+    except sqlite3.IntegrityError:
+        pass
+    else:
+        raise AssertionError("insert was not rejected")
+    assert conn.execute("SELECT count(*) FROM known_shipments").fetchone() == (
+        1,
+    )
+    assert "LN-1" not in (doc_client._known_refs(conn) or ())
+
+
+def test_refresh_shipment_concurrent_refreshes_all_finish(monkeypatch):
+    def get_status(pro, *args):
+        return {
+            "pro": pro,
+            "status": "DELIVERED",
+            "longstatus": "Delivered",
+            "delivery_time": "14:32",
+        }
+
+    monkeypatch.setattr(doc_client, "get_status", get_status)
+    monkeypatch.setattr(
+        doc_client,
+        "_download_images",
+        lambda pro, *args: iter([(f"{pro}_1.jpg", b"JFIF")]),
+    )
+    monkeypatch.setattr(
+        doc_client,
+        "_download_pdf",
+        lambda pro, which, *args: (f"{pro}_{which}.pdf", b"%PDF"),
+    )
+    results = {}
+    errors = []
+
+    def refresh(pro):
+        conn = doc_client.CachedConnection(":memory:")
+        doc_client.setup_schema(conn)
+        try:
+            for _ in range(20):
+                results[pro] = doc_client.refresh_shipment(
+                    conn, pro, pdfs=("lading", "proof")
+                )
+        except Exception as err:
+            errors.append(err)
+        results[pro, "stored"] = conn.execute(
+            "SELECT count(*) FROM shipment_images"
+        ).fetchone()
+
+    threads = [
+        threading.Thread(target=refresh, args=(str(pro),)) for pro in range(20)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    for pro in map(str, range(20)):
+        assert results[pro, "stored"] == (3,)
+        result = results[pro]
+        assert result["status"]["pro"] == pro
+        assert result["images"] == [f"{pro}_1.jpg"]
+        assert result["pdfs"] == {
+            "lading": f"{pro}_lading.pdf",
+            "proof": f"{pro}_proof.pdf",
+        }
+
+
+def test_shard_for_and_shard_files():
+    assert doc_client.shard_for("LN-12345", 1) == 0
+    shards = {doc_client.shard_for(f"LN-{pro}", 4) for pro in range(100)}
+    assert shards == {0, 1, 2, 3}
+    # crc32, so the same in every process
+    assert doc_client.shard_for("LN-12345", 4) == 2
+    assert doc_client.shard_files("data/fm.sqlite3", 1) == ["data/fm.sqlite3"]
+    assert doc_client.shard_files("data/fm.sqlite3", 3) == [
+        "data/fm.0.sqlite3",
+        "data/fm.1.sqlite3",
+        "data/fm.2.sqlite3",
+    ]
+
+
+def test_handle_request_routes_to_shard_by_ref(tmp_path):
+    conns = doc_client.open_shards(str(tmp_path / "fm.sqlite3"), 3)
+    for ref in ("R1", "R2", "R3", "R4"):
+        resp = doc_client.handle_request(
+            conns, f"ref={ref}&what=start", False, False
+        )
+        assert resp == "ok"
+
+    for i, conn in enumerate(conns):
+        rows = conn.execute("SELECT pro FROM known_shipments").fetchall()
+        assert rows == [
+            (ref,)
+            for ref in ("R1", "R2", "R3", "R4")
+            if doc_client.shard_for(ref, 3) == i
+        ]
+
+
+def test_query_shards_merges_in_order(tmp_path):
+    conns = doc_client.open_shards(str(tmp_path / "fm.sqlite3"), 3)
+    for pro in range(20):
+        known_pro = f"LN-{pro:02d}"
+        _insert_shipment(
+            doc_client.shard_conn(conns, known_pro), known_pro, "DELIVERED"
+        )
+
+    rows = doc_client.query_shards(
+        conns,
+        "SELECT pro FROM known_shipments ORDER BY pro",
+        key=lambda row: row[0],
+    )
+    assert list(rows) == [(f"LN-{pro:02d}",) for pro in range(20)]
+    unordered = doc_client.query_shards(
+        conns, "SELECT pro FROM known_shipments"
+    )
+    assert sorted(unordered) == [(f"LN-{pro:02d}",) for pro in range(20)]
+
+
+def _fake_get_many_to_db(conn, pros, scac_or_carrier_id, deadline):
+    filename = conn.execute("PRAGMA database_list").fetchone()[2]
+    shard = int(filename.rsplit(".", 2)[-2])
+    return {
+        "done": [
+            pro
+            for pro in pros
+            if doc_client.shard_for(f"{scac_or_carrier_id}-{pro}", 3) == shard
+        ],
+        "errors": {pro: {"shard": shard} for pro in pros[:1]},
+        "unfinished": [],
+        "partial": {},
+    }
+
+
+def test_sync_sharded_combines_shard_results(tmp_path, monkeypatch):
+    fork = multiprocessing.get_context("fork")
+    shard_pool = doc_client._shard_pool
+    monkeypatch.setattr(
+        doc_client, "_shard_pool", lambda workers: shard_pool(workers, fork)
+    )
+    monkeypatch.setattr(doc_client, "get_many_to_db", _fake_get_many_to_db)
+    pros = [str(pro) for pro in range(30)]
+
+    results = doc_client.sync_sharded(str(tmp_path / "fm.sqlite3"), 3, pros)
+
+    assert sorted(results["done"]) == sorted(pros)
+    assert sorted(error["shard"] for error in results["errors"].values()) == [
+        0,
+        1,
+        2,
+    ]
+    assert results["unfinished"] == []
+    assert results["partial"] == {}
+
+
+def test_shard_pool_passes_settings_to_spawned_workers(monkeypatch):
+    monkeypatch.setattr(doc_client.settings, "READ_TIMEOUT", 1.5)
+    monkeypatch.setattr(
+        doc_client.settings, "LIMINAL_NETWORK_FINAL_MILE_API_KEY", "from-cli"
+    )
+    spawn = multiprocessing.get_context("spawn")
+    with doc_client._shard_pool(1, spawn) as pool:
+        read_timeout = pool.submit(
+            getattr, doc_client.settings, "READ_TIMEOUT"
+        )
+        api_key = pool.submit(doc_client.get_api_key, "LN")
+        assert read_timeout.result() == 1.5
+        assert api_key.result() == "from-cli"
+
+
+def test_status_records_store_what_get_status_to_db_stores(monkeypatch):
+    statuses = [
+        {
+            "pro": "P1",
+            "status": "DELIVERED",
+            "longstatus": "Delivered",
+            "delivery_date": "2024-05-01",
+            "delivery_time": "14:32",
+        },
+        {
+            "pro": "P2",
+            "status": "IN_TRANSIT",
+            "longstatus": "In transit",
+            "delivery_time": None,
+        },
+    ]
+    by_pro = {status["pro"]: status for status in statuses}
+    monkeypatch.setattr(
+        doc_client, "get_status", lambda pro, *args: by_pro[pro]
+    )
+    query = """
+        SELECT pro, status, longstatus, delivery_time, delivery_date
+        FROM known_shipments
+        ORDER BY pro
+    """
+    expected = sqlite3.connect(":memory:")
+    doc_client.setup_schema(expected)
+    for status in statuses:
+        doc_client.get_status_to_db(expected, status["pro"], "SCAC")
+    expected = expected.execute(query).fetchall()
+    assert expected[0][0] == "SCAC-P1"
+    assert expected[0][4] == "2024-05-01"
+
+    records = [
+        doc_client.StatusRecord.from_status(status, "SCAC")
+        for status in statuses
+    ]
+    batch = doc_client.StatusBatch()
+    for status in statuses:
+        batch.append(status, "SCAC")
+    assert [record.to_params() for record in records] == expected
+    assert list(batch.to_params()) == expected
+    for records in (records, batch):
+        conn = sqlite3.connect(":memory:")
+        doc_client.setup_schema(conn)
+        assert doc_client.insert_statuses(conn, records) == 2
+        assert conn.execute(query).fetchall() == expected
+
+
+def test_insert_statuses_fills_known_refs_cache():
+    conn = doc_client.CachedConnection(":memory:")
+    doc_client.setup_schema(conn)
+    doc_client._known_refs(conn)
+    status = {
+        "pro": "P1",
+        "status": "DELIVERED",
+        "longstatus": "Delivered",
+        "delivery_time": "14:32",
+    }
+
+    doc_client.insert_statuses(
+        conn, [doc_client.StatusRecord.from_status(status, "LN")]
+    )
+
+    assert "LN-P1" in doc_client._known_refs(conn)
+
+
+def test_profile_summary_counts_other_time(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(doc_client.time, "perf_counter", lambda: clock[0])
+    profile = doc_client.Profile()
+
+    with profile.item("a"):
+        with profile.phase("db"):
+            clock[0] += 1.0
+        with profile.item("b"):
+            with profile.phase("network"):
+                clock[0] += 2.0
+            clock[0] += 1.0
+        # back in item a
+        with profile.phase("file"):
+            clock[0] += 0.5
+        clock[0] += 0.5
+    with profile.phase("decode"):
+        clock[0] += 0.25
+
+    assert profile.summary(top=1).splitlines() == [
+        "time per phase:",
+        "  network       2.000s  25.0%",
+        "  decode        0.250s   3.1%",
+        "  db            1.000s  12.5%",
+        "  file          0.500s   6.2%",
+        "  other         4.500s  56.2%",
+        "slowest 1 of 3:",
+        "  a 5.000s db=1.000s file=0.500s other=3.500s",
+    ]
+    assert profile.times["b"]["other"] == 1.0
+    assert profile.times["(no item)"]["decode"] == 0.25
+
+
+def test_profile_item_carries_into_refresh_threads(monkeypatch):
+    def get_status(pro, *args):
+        with doc_client._phase("network"):
+            return {
+                "pro": pro,
+                "status": "DELIVERED",
+                "longstatus": "Delivered",
+                "delivery_time": "14:32",
+            }
+
+    monkeypatch.setattr(doc_client, "get_status", get_status)
+    monkeypatch.setattr(doc_client, "_download_images", lambda *args: iter(()))
+    monkeypatch.setattr(
+        doc_client, "_download_pdf", lambda *args: ("1.pdf", b"%PDF")
+    )
+    conn = doc_client.CachedConnection(":memory:")
+    doc_client.setup_schema(conn)
+    profile = doc_client.start_profiling()
+    try:
+        with doc_client._profile_item("1"):
+            doc_client.refresh_shipment(conn, "1")
+    finally:
+        doc_client.stop_profiling()
+
+    assert set(profile.times) == {"1"}
+    assert profile.times["1"]["network"] > 0